@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+#MODULE:     benchmark_r_in_usgs
+#
+#PURPOSE:    Benchmark r.in.usgs offline against a local stand-in for the
+#            USGS TNM Access API serving synthetic NED and NLCD tiles.
+#
+#COPYRIGHT:  (C) 2017 the GRASS Development Team
+#
+#            This program is free software under the GNU General Public
+#            License (>=v2). Read the file COPYING that comes with GRASS
+#            for details.
+
+"""Offline benchmark of r.in.usgs
+
+Run inside a GRASS session, e.g.:
+
+    python benchmark_r_in_usgs.py --product ned --tiles 3x2 \\
+        --bandwidth 5000000 --latency 0.05 \\
+        --max-connections 1,4 --nprocs 1,4 --repeat 3
+
+Synthetic tiles are generated with GDAL (NED as ERDAS Imagine .img,
+NLCD as GeoTIFF, both zipped) on a grid of 1x1 (NED) or 3x3 (NLCD)
+degree cells and served with the TNM products listing by a local HTTP
+server with optional bandwidth limit and latency. The computational
+region is set to the tile grid in a temporary region, r.in.usgs main()
+runs in this process and the wall time of the whole run and of each
+stage (API query, download, extraction, r.import, r.patch) is reported.
+Download, extraction and import overlap, so their times are the time
+spent in each stage summed over all tiles next to the wall time from
+the first to the last call.
+"""
+
+import os
+import sys
+import imp
+import json
+import time
+import array
+import shutil
+import zipfile
+import argparse
+import tempfile
+import threading
+import itertools
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+import grass.script as gscript
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, 'r.in.usgs.py')
+NAD83 = "+proj=longlat +ellps=GRS80 +datum=NAD83 +nodefs"
+NLCD_CLASSES = (11, 21, 22, 41, 42, 52, 71, 81, 82, 90)
+
+
+def load_module():
+    """Load r.in.usgs as a Python module without running it"""
+    return imp.load_source('r_in_usgs', MODULE_PATH)
+
+
+def module_defaults():
+    """Return default options and flags from the r.in.usgs interface"""
+    options, flags = {}, {}
+    current = None
+    with open(MODULE_PATH) as module_file:
+        for line in module_file:
+            if line.startswith('#%option'):
+                current = options
+            elif line.startswith('#%flag'):
+                current = flags
+            elif line.startswith('#% key:') and current is not None:
+                key = line.split(':', 1)[1].strip()
+                current[key] = '' if current is options else False
+            elif line.startswith('#% answer:') and current is options:
+                options[key] = line.split(':', 1)[1].strip()
+            elif line.startswith('#%end'):
+                current = None
+    return options, flags
+
+
+def write_tile(path, driver_name, west, north, degrees, size, nlcd):
+    """Write a synthetic tile with GDAL"""
+    from osgeo import gdal, osr
+    driver = gdal.GetDriverByName(driver_name)
+    data_type = gdal.GDT_Byte if nlcd else gdal.GDT_Float32
+    dataset = driver.Create(path, size, size, 1, data_type)
+    dataset.SetGeoTransform((west, float(degrees) / size, 0,
+                             north, 0, -float(degrees) / size))
+    reference = osr.SpatialReference()
+    reference.ImportFromProj4(NAD83)
+    dataset.SetProjection(reference.ExportToWkt())
+    if nlcd:
+        values = array.array('B', (NLCD_CLASSES[(row / 8 + col / 8) % len(NLCD_CLASSES)]
+                                   for row in range(size) for col in range(size)))
+    else:
+        values = array.array('f', (100 + (row * 7 + col * 3) % 500
+                                   for row in range(size) for col in range(size)))
+    dataset.GetRasterBand(1).WriteRaster(0, 0, size, size, values.tostring())
+    dataset = None
+
+
+def generate_tiles(directory, product, columns, rows, size, north=37, west=-80):
+    """Generate zipped tiles and the matching TNM API items
+
+    Returns (items, bbox) where bbox is (west, south, east, north) of the
+    tile grid. Item download URLs are relative to the server root.
+    """
+    nlcd = product == 'nlcd'
+    degrees = 3 if nlcd else 1
+    items = []
+    for row, col in itertools.product(range(rows), range(columns)):
+        tile_north = north - row * degrees
+        tile_west = west + col * degrees
+        tile_id = "n{0:02d}w{1:03d}".format(tile_north, -tile_west)
+        if nlcd:
+            name = "NLCD2011_LC_{0}".format(tile_id.upper())
+            tile_name, zip_name = name + '.tif', name + '.zip'
+            url = "/download?dataset=nlcd&FNAME=" + zip_name
+            title = "NLCD 2011 Land Cover {0}".format(tile_id)
+            dataset_name = 'National Land Cover Database (NLCD) - 2011'
+        else:
+            tile_name, zip_name = "img{0}_13.img".format(tile_id), tile_id + '.zip'
+            url = "/files/" + zip_name
+            title = "USGS NED {0} 1/3 arc-second 2013 1 x 1 degree IMG".format(tile_id)
+            dataset_name = 'National Elevation Dataset (NED) 1/3 arc-second'
+        tile_path = os.path.join(directory, tile_name)
+        write_tile(tile_path, 'GTiff' if nlcd else 'HFA', tile_west, tile_north,
+                   degrees, size, nlcd)
+        zip_path = os.path.join(directory, zip_name)
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as tile_zip:
+            tile_zip.write(tile_path, tile_name)
+        os.remove(tile_path)
+        items.append({'title': title,
+                      'downloadURL': url,
+                      'sizeInBytes': os.path.getsize(zip_path),
+                      'lastUpdated': '2017-01-01',
+                      'datasets': [dataset_name],
+                      'boundingBox': {'minX': tile_west,
+                                      'maxX': tile_west + degrees,
+                                      'minY': tile_north - degrees,
+                                      'maxY': tile_north}})
+    bbox = (west, north - rows * degrees, west + columns * degrees, north)
+    return items, bbox
+
+
+class MockTNMHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """TNM products endpoint and tile downloads with Range support"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        parts = urlparse.urlsplit(self.path)
+        query = urlparse.parse_qs(parts.query)
+        if parts.path.endswith('/products'):
+            offset = int(query.get('offset', ['0'])[0])
+            page_size = int(query.get('max', ['10'])[0])
+            items = [dict(item, downloadURL=self.server.base_url + item['downloadURL'])
+                     for item in self.server.items]
+            body = json.dumps({'total': len(items), 'errors': [],
+                               'items': items[offset:offset + page_size]})
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if 'FNAME' in query:
+            name = query['FNAME'][0]
+        else:
+            name = os.path.basename(parts.path)
+        path = os.path.join(self.server.directory, name)
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        size = os.path.getsize(path)
+        start = 0
+        byte_range = self.headers.get('Range', '')
+        if byte_range.startswith('bytes='):
+            start = int(byte_range[6:].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes {0}-{1}/{2}'.format(start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(size - start))
+        self.send_header('Last-Modified', 'Sun, 01 Jan 2017 00:00:00 GMT')
+        self.end_headers()
+        chunk_size = 16 * 1024
+        with open(path, 'rb') as tile_file:
+            tile_file.seek(start)
+            while True:
+                chunk = tile_file.read(chunk_size)
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                if self.server.bandwidth:
+                    time.sleep(float(len(chunk)) / self.server.bandwidth)
+
+
+class MockTNMServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, directory, items, bandwidth=0, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), MockTNMHandler)
+        self.directory = directory
+        self.items = items
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.base_url = 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class StageTimer(object):
+    """Busy time and first to last call span of each stage"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.busy = {}
+        self.span = {}
+
+    def record(self, stage, start, end):
+        with self.lock:
+            self.busy[stage] = self.busy.get(stage, 0) + end - start
+            first, last = self.span.get(stage, (start, end))
+            self.span[stage] = (min(first, start), max(last, end))
+
+    def wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(stage, start, time.time())
+        return timed
+
+    def wrap_generator(self, stage, function):
+        def timed(*args, **kwargs):
+            generator = function(*args, **kwargs)
+            while True:
+                start = time.time()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    self.record(stage, start, time.time())
+                    return
+                self.record(stage, start, time.time())
+                yield item
+        return timed
+
+    def report(self):
+        return dict((stage, {'busy': self.busy[stage],
+                             'wall': self.span[stage][1] - self.span[stage][0]})
+                    for stage in self.busy)
+
+
+def instrument(module, timer):
+    """Wrap r.in.usgs functions and GRASS modules with stage timers
+
+    Returns a function which removes the wrappers.
+    """
+    originals = [(module, 'query_TNM', module.query_TNM),
+                 (module, 'fetch_tile', module.fetch_tile),
+                 (module, 'extract_member', module.extract_member),
+                 (gscript, 'run_command', gscript.run_command)]
+    module.query_TNM = timer.wrap_generator('query', module.query_TNM)
+    module.fetch_tile = timer.wrap('download', module.fetch_tile)
+    module.extract_member = timer.wrap('extract', module.extract_member)
+    run_command = gscript.run_command
+
+    def timed_run_command(module_name, *args, **kwargs):
+        if module_name in ('r.import', 'r.patch', 'r.colors'):
+            return timer.wrap(module_name, run_command)(module_name, *args, **kwargs)
+        return run_command(module_name, *args, **kwargs)
+    gscript.run_command = timed_run_command
+
+    def restore():
+        for owner, name, original in originals:
+            setattr(owner, name, original)
+    return restore
+
+
+def set_region(bbox, product, size):
+    """Set the temporary region to the tile grid at about tile resolution"""
+    west, south, east, north = bbox
+    degrees = 3 if product == 'nlcd' else 1
+    if gscript.locn_is_latlong():
+        gscript.run_command('g.region', n=north, s=south, e=east, w=west,
+                            res=float(degrees) / size)
+        return
+    # the region covers the part of the grid inside the projected corners
+    corners = []
+    for lon, lat in ((west, south), (east, north), (west, north), (east, south)):
+        output = gscript.read_command('m.proj', coordinates=(lon, lat),
+                                      proj_in=NAD83, separator='comma')
+        corners.append([float(value) for value in output.split(',')[:2]])
+    xs = sorted(corner[0] for corner in corners)
+    ys = sorted(corner[1] for corner in corners)
+    gscript.run_command('g.region', w=xs[1], e=xs[2], s=ys[1], n=ys[2],
+                        res=(xs[2] - xs[1]) / (size * (east - west) / degrees))
+
+
+def run_once(module, options, flags):
+    module.options, module.flags = options, flags
+    del module.cleanup_list[:]
+    start = time.time()
+    try:
+        module.main()
+    except SystemExit as error:
+        if error.code:
+            raise
+    finally:
+        module.cleanup()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of r.in.usgs")
+    parser.add_argument('--product', choices=('ned', 'nlcd'), default='ned')
+    parser.add_argument('--tiles', default='2x2',
+                        help="Tile grid as COLUMNSxROWS")
+    parser.add_argument('--tile-size', type=int, default=360,
+                        help="Width and height of each tile in cells")
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help="Server bandwidth per connection in bytes/s (0 for no limit)")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Server latency per request in seconds")
+    parser.add_argument('--max-connections', default='4',
+                        help="Comma separated values to compare")
+    parser.add_argument('--nprocs', default='1',
+                        help="Comma separated values to compare")
+    parser.add_argument('--flags', default='',
+                        help="r.in.usgs flags to set, e.g. 'zm'")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--warm', action='store_true',
+                        help="Keep the tile cache between runs")
+    parser.add_argument('--output', help="Write results as JSON to this file")
+    args = parser.parse_args()
+
+    columns, rows = [int(value) for value in args.tiles.lower().split('x')]
+    work_dir = tempfile.mkdtemp(prefix='r_in_usgs_benchmark_')
+    tile_dir = os.path.join(work_dir, 'server')
+    os.mkdir(tile_dir)
+    module = load_module()
+    results = []
+    try:
+        items, bbox = generate_tiles(tile_dir, args.product, columns, rows,
+                                     args.tile_size)
+        server = MockTNMServer(tile_dir, items, args.bandwidth, args.latency)
+        server.start()
+        module.TNM_API_BASE_URL = server.base_url + '/tnmaccess/api/products?'
+        gscript.use_temp_region()
+        set_region(bbox, args.product, args.tile_size)
+        output_name = 'r_in_usgs_benchmark_{0}'.format(os.getpid())
+        defaults, default_flags = module_defaults()
+        configurations = itertools.product(
+            [int(value) for value in args.max_connections.split(',')],
+            [int(value) for value in args.nprocs.split(',')])
+        for max_connections, nprocs in configurations:
+            for repeat in range(args.repeat):
+                download_dir = os.path.join(work_dir, 'download')
+                if not args.warm and os.path.isdir(download_dir):
+                    shutil.rmtree(download_dir)
+                if not os.path.isdir(download_dir):
+                    os.mkdir(download_dir)
+                options = dict(defaults, product=args.product,
+                               output_directory=download_dir,
+                               output_name=output_name,
+                               max_connections=str(max_connections),
+                               nprocs=str(nprocs), query_ttl='0')
+                flags = dict(default_flags)
+                for flag in args.flags:
+                    flags[flag] = True
+                timer = StageTimer()
+                restore = instrument(module, timer)
+                try:
+                    wall = run_once(module, options, flags)
+                finally:
+                    restore()
+                gscript.run_command('g.remove', type='raster', name=output_name,
+                                    flags='f', quiet=True)
+                result = {'max_connections': max_connections, 'nprocs': nprocs,
+                          'repeat': repeat, 'tiles': len(items),
+                          'bytes': sum(item['sizeInBytes'] for item in items),
+                          'wall': wall, 'stages': timer.report()}
+                results.append(result)
+                stages = ', '.join("{0} {1:.2f}s ({2:.2f}s busy)".format(
+                                   stage, times['wall'], times['busy'])
+                                   for stage, times in sorted(result['stages'].items()))
+                print("max_connections={0} nprocs={1} run {2}: {3:.2f}s total; {4}".format(
+                      max_connections, nprocs, repeat + 1, wall, stages))
+    finally:
+        gscript.del_temp_region()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -44,20 +44,21 @@
 #%option
 #% key: ned_dataset
 #% required: no
-#% options: 1 arc-second, 1/3 arc-second, 1/9 arc-second
+#% options: auto, 1 arc-second, 1/3 arc-second, 1/9 arc-second
 #% answer: 1/3 arc-second
 #% label: NED dataset
-#% description: Available NED datasets to query
+#% description: Available NED datasets to query, auto selects the coarsest dataset meeting the region resolution
 #% guisection: NED
 #%end
 
 #%option
 #% key: nlcd_dataset
 #% required: no
+#% multiple: yes
 #% options: nlcd2001, nlcd2006, nlcd2011
 #% answer: nlcd2011
 #% label: NLCD dataset
-#% description: Available NLCD datasets to query
+#% description: Available NLCD datasets to query, several datasets are imported into a space-time raster dataset
 #% descriptions: nlcd2001;National Land Cover Dataset - 2001;nlcd2006;National Land Cover Dataset - 2006;nlcd2011;National Land Cover Dataset - 2011
 #% guisection: NLCD
 #%end
@@ -65,6 +66,7 @@
 #%option
 #% key: nlcd_subset
 #% required: no
+#% multiple: yes
 #% options: land_cover, impervious, canopy
 #% answer: land_cover
 #% label: NLCD subset
@@ -120,6 +122,155 @@
 #% guisection: Download Options
 #%end
 
+#%option
+#% key: overviews
+#% type: integer
+#% required: no
+#% multiple: yes
+#% label: Downsampling factors of overview raster maps
+#% description: Overviews are named after the output with suffix _ovr and the factor, e.g. 2,4,8,16
+#% guisection: Download Options
+#%end
+
+#%option G_OPT_V_INPUT
+#% key: aoi
+#% required: no
+#% label: Name of vector map with areas of interest
+#% description: One raster map named output_name_<category> is created for the bounding box of each area
+#% guisection: Batch
+#%end
+
+#%option G_OPT_F_INPUT
+#% key: regions
+#% required: no
+#% label: Name of file with regions of interest
+#% description: One region per line as name,north,south,east,west; one raster map named output_name_<name> is created for each
+#% guisection: Batch
+#%end
+
+#%option G_OPT_F_OUTPUT
+#% key: plan
+#% required: no
+#% label: Name for output JSON file with the download plan ('-' for standard output)
+#% description: Lists tiles with cache status and estimates download size, scratch space, output size and download time
+#% guisection: USGS Data Selection
+#%end
+
+#%option G_OPT_F_OUTPUT
+#% key: metrics
+#% required: no
+#% label: Name for output file with timing and throughput metrics ('-' for standard output)
+#% description: Wall time and bytes of each processing stage, retries and cache hits of the run
+#% guisection: Download Options
+#%end
+
+#%option
+#% key: metrics_format
+#% type: string
+#% required: no
+#% multiple: no
+#% options: json,prometheus
+#% answer: json
+#% label: Format of the metrics file
+#% descriptions: json;JSON report;prometheus;Prometheus text format for the node exporter textfile collector
+#% guisection: Download Options
+#%end
+
+#%option
+#% key: max_connections
+#% type: integer
+#% required: no
+#% multiple: no
+#% answer: 4
+#% label: Maximum number of parallel downloads
+#% description: Number of tiles downloaded at the same time over persistent connections
+#% guisection: Download Options
+#%end
+
+#%option
+#% key: retries
+#% type: integer
+#% required: no
+#% multiple: no
+#% answer: 3
+#% label: Number of retries for interrupted downloads
+#% description: Interrupted downloads are resumed from the last received byte
+#% guisection: Download Options
+#%end
+
+#%option G_OPT_M_DIR
+#% key: cache_dir
+#% required: no
+#% label: Directory for the shared tile cache
+#% description: Downloaded files are kept and reused from this directory (default: output_directory)
+#% guisection: Download Options
+#%end
+
+#%option
+#% key: cache_size
+#% type: integer
+#% required: no
+#% multiple: no
+#% answer: 0
+#% label: Maximum size of the tile cache in MB
+#% description: Least recently used files are removed when the cache is larger (0 for no limit)
+#% guisection: Download Options
+#%end
+
+#%option
+#% key: query_ttl
+#% type: double
+#% required: no
+#% multiple: no
+#% answer: 24
+#% label: Time in hours for which TNM API responses are reused
+#% description: Queries for a region within a previously queried region are answered from the cache (0 to always query the API)
+#% guisection: Download Options
+#%end
+
+#%option
+#% key: nprocs
+#% type: integer
+#% required: no
+#% multiple: no
+#% answer: 1
+#% label: Number of parallel tile imports
+#% description: Number of r.import processes reprojecting tiles and of archives extracted at the same time
+#% guisection: Download Options
+#%end
+
+#%option
+#% key: scratch_size
+#% type: integer
+#% required: no
+#% multiple: no
+#% label: Maximum scratch space in output_directory in MB
+#% description: Tiles are processed a few at a time and their files removed as soon as they are imported
+#% guisection: Download Options
+#%end
+
+#%option
+#% key: import_cache
+#% type: string
+#% required: no
+#% multiple: no
+#% key_desc: name
+#% label: Name of mapset for the cache of imported tiles
+#% description: Reprojected tiles are kept in this mapset and reused by later runs with the same resolution, grid alignment and resampling method
+#% guisection: Download Options
+#%end
+
+#%option
+#% key: import_cache_size
+#% type: integer
+#% required: no
+#% multiple: no
+#% answer: 0
+#% label: Maximum size of the cache of imported tiles in MB
+#% description: Least recently used tiles are removed when the cache mapset is larger (0 for no limit)
+#% guisection: Download Options
+#%end
+
 #%flag
 #% key: k
 #% label: Keep extracted files after GRASS import and patch
@@ -127,22 +278,1973 @@
 #% guisection: Download Options
 #%end
 
-#%rules
-#% required: output_name, -i
-#%end
+#%flag
+#% key: z
+#% label: Import tiles directly from ZIP archives without extracting them
+#% description: GDAL reads the tiles from the archives through /vsizip/
+#% guisection: Download Options
+#%end
+
+#%flag
+#% key: m
+#% label: Import all tiles as one mosaic instead of importing and patching each tile
+#% description: Tiles are combined in a GDAL VRT which is reprojected in a single pass
+#% guisection: Download Options
+#%end
+
+#%flag
+#% key: l
+#% label: Link tiles with r.external instead of importing them when no reprojection is needed
+#% description: Output is a virtual raster of the linked tiles kept in cache_dir
+#% guisection: Download Options
+#%end
+
+#%flag
+#% key: r
+#% label: Read tiles remotely with HTTP range requests instead of downloading them
+#% description: Only the parts of tiles needed for the region are read and kept in a block cache in cache_dir
+#% guisection: Download Options
+#%end
+
+#%flag
+#% key: u
+#% label: Update existing output with tiles of the grown region
+#% description: Only tiles not yet imported into output_name are downloaded and patched with it
+#% guisection: Download Options
+#%end
+
+#%rules
+#% required: output_name, -i
+#% exclusive: aoi, regions
+#% exclusive: -u, aoi
+#% exclusive: -u, regions
+#% exclusive: scratch_size, -k
+#% exclusive: scratch_size, -m
+#% exclusive: scratch_size, aoi
+#% exclusive: scratch_size, regions
+#% exclusive: -l, -m
+#% exclusive: -l, -z
+#% exclusive: -l, -u
+#% exclusive: -l, scratch_size
+#% exclusive: -l, aoi
+#% exclusive: -l, regions
+#% exclusive: -r, -l
+#%end
+
+import sys
+import os
+import zipfile
+import grass.script as gscript
+import urllib
+import urlparse
+import httplib
+import socket
+import threading
+import Queue
+import json
+import math
+import time
+import sqlite3
+import hashlib
+import base64
+import re
+import shutil
+import zlib
+import atexit
+import BaseHTTPServer
+import SocketServer
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from osgeo import osr
+except ImportError:
+    osr = None
+
+from grass.exceptions import CalledModuleError
+
+cleanup_list = []
+
+# TNM Access API products endpoint
+TNM_API_BASE_URL = "https://viewer.nationalmap.gov/tnmaccess/api/products?"
+
+# minimum time in seconds between two download progress reports
+PROGRESS_INTERVAL = 0.5
+
+
+class Metrics(object):
+    """Wall time, bytes and counts of the processing stages of a run
+
+    Calls of a stage may run in several threads at once, so for each
+    stage both the time spent in all calls and the wall time from the
+    start of the first to the end of the last call are recorded.
+    Counters hold events such as retries and cache hits.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.labels = {}
+        self._stages = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, started, nbytes=0):
+        """Record one call of a stage which began at time started"""
+        finished = time.time()
+        with self._lock:
+            record = self._stages.setdefault(stage, {'count': 0, 'seconds': 0.,
+                                                     'bytes': 0, 'first': started,
+                                                     'last': finished})
+            record['count'] += 1
+            record['seconds'] += finished - started
+            record['bytes'] += nbytes or 0
+            record['first'] = min(record['first'], started)
+            record['last'] = max(record['last'], finished)
+
+    @contextmanager
+    def stage(self, stage, nbytes=0):
+        """Record the time spent in a with block as one call of a stage"""
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, started, nbytes)
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + n
+
+    def report(self):
+        """Return the metrics as a dict"""
+        with self._lock:
+            stages = {}
+            for name, record in self._stages.items():
+                wall = record['last'] - record['first']
+                stages[name] = {
+                    'count': record['count'],
+                    'seconds': record['seconds'],
+                    'wall_seconds': wall,
+                    'bytes': record['bytes'],
+                    'bytes_per_second': (record['bytes'] / wall
+                                         if record['bytes'] and wall > 0 else None),
+                    }
+            counters = dict(self._counters)
+        lookups = counters.get('cache_hits', 0) + counters.get('cache_misses', 0)
+        return {'labels': self.labels,
+                'seconds': time.time() - self.started,
+                'stages': stages,
+                'counters': counters,
+                'cache_hit_ratio': (float(counters.get('cache_hits', 0)) / lookups
+                                    if lookups else None)}
+
+    def prometheus(self):
+        """Return the metrics in Prometheus text exposition format"""
+        report = self.report()
+
+        def sample(name, value, **labels):
+            labels.update(self.labels)
+            label_str = ",".join('{0}="{1}"'.format(
+                key, str(labels[key]).replace('\\', '\\\\').replace('"', '\\"'))
+                for key in sorted(labels))
+            return "r_in_usgs_{0}{{{1}}} {2!r}".format(name, label_str,
+                                                        float(value))
+
+        lines = ["# HELP r_in_usgs_run_seconds Wall time of the run",
+                 "# TYPE r_in_usgs_run_seconds gauge",
+                 sample('run_seconds', report['seconds'])]
+        for key, description in (
+                ('seconds', "Time spent in calls of the stage summed over threads"),
+                ('wall_seconds', "Time from the start of the first to the end of the last call of the stage"),
+                ('bytes', "Bytes processed by the stage"),
+                ('count', "Number of calls of the stage")):
+            name = 'stage_' + key
+            lines.append("# HELP r_in_usgs_{0} {1}".format(name, description))
+            lines.append("# TYPE r_in_usgs_{0} gauge".format(name))
+            for stage in sorted(report['stages']):
+                lines.append(sample(name, report['stages'][stage][key], stage=stage))
+        lines.append("# HELP r_in_usgs_events Number of events of the run")
+        lines.append("# TYPE r_in_usgs_events gauge")
+        for counter in sorted(report['counters']):
+            lines.append(sample('events', report['counters'][counter], event=counter))
+        if report['cache_hit_ratio'] is not None:
+            lines.append("# HELP r_in_usgs_cache_hit_ratio Share of tiles found in the tile cache")
+            lines.append("# TYPE r_in_usgs_cache_hit_ratio gauge")
+            lines.append(sample('cache_hit_ratio', report['cache_hit_ratio']))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, format='json'):
+        """Write the metrics to path, '-' for standard output"""
+        if format == 'prometheus':
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.report(), indent=2, sort_keys=True) + "\n"
+        if path == '-':
+            sys.stdout.write(text)
+            return
+        # textfile collectors may read the file at any time, so it is
+        # replaced at once
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(text)
+        os.rename(temp_path, path)
+
+
+# metrics of the current run
+metrics = Metrics()
+
+
+class DownloadError(Exception):
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class ConnectionPool(object):
+    """Persistent HTTP(S) connections kept alive per worker thread and host
+
+    Each thread gets its own connection to each host so that several
+    tiles can be transferred at once while the TLS handshake is paid only
+    once per thread and host. Proxies are taken from the http_proxy,
+    https_proxy and no_proxy environment variables as urllib2 does.
+    """
+    def __init__(self, timeout=12):
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all = []
+
+    @staticmethod
+    def _proxy(scheme, netloc):
+        """Return (proxy host, headers) for a host or None without proxy"""
+        proxy = urllib.getproxies().get(scheme)
+        if not proxy or urllib.proxy_bypass(netloc.split(':')[0]):
+            return None
+        parts = urlparse.urlsplit(proxy if '//' in proxy else '//' + proxy)
+        headers = {}
+        if parts.username:
+            credentials = "{0}:{1}".format(urllib.unquote(parts.username),
+                                           urllib.unquote(parts.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials)
+        host = parts.hostname
+        if parts.port:
+            host += ':{0}'.format(parts.port)
+        return host, headers
+
+    def _connection(self, scheme, netloc, fresh=False):
+        conns = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = {}
+        key = (scheme, netloc)
+        if fresh and key in conns:
+            conns.pop(key).close()
+        if key not in conns:
+            proxy = self._proxy(scheme, netloc)
+            host = proxy[0] if proxy else netloc
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(host, timeout=self.timeout)
+                # HTTPS goes through a CONNECT tunnel
+                if proxy:
+                    conn.set_tunnel(netloc, headers=proxy[1])
+                conn.proxy_headers = None
+            else:
+                conn = httplib.HTTPConnection(host, timeout=self.timeout)
+                # plain HTTP requests are sent to the proxy with the full URL
+                conn.proxy_headers = proxy[1] if proxy else None
+            conns[key] = conn
+            with self._lock:
+                self._all.append(conn)
+        return conns[key]
+
+    @staticmethod
+    def _send(conn, url, path, headers):
+        if conn.proxy_headers is not None:
+            conn.request('GET', url.split('#')[0],
+                         headers=dict(headers, **conn.proxy_headers))
+        else:
+            conn.request('GET', path, headers=headers)
+        return conn.getresponse()
+
+    def open(self, url, headers=None, max_redirects=5):
+        """Send GET request and return the response, following redirects
+
+        The caller must read the whole response before the next request
+        is sent from the same thread.
+        """
+        headers = headers or {}
+        for redirect in range(max_redirects + 1):
+            parts = urlparse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            try:
+                conn = self._connection(parts.scheme, parts.netloc)
+                response = self._send(conn, url, path, headers)
+            except (httplib.HTTPException, socket.error):
+                # server closed the kept-alive connection, reconnect once
+                conn = self._connection(parts.scheme, parts.netloc, fresh=True)
+                response = self._send(conn, url, path, headers)
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('location')
+                response.read()
+                url = urlparse.urljoin(url, location)
+                continue
+            if response.status >= 400:
+                response.read()
+                raise DownloadError("HTTP {0} {1}".format(response.status,
+                                                          response.reason),
+                                    status=response.status)
+            return response
+        raise DownloadError("Too many redirects")
+
+    def reset(self, url):
+        """Close the connection of this thread to the host of url
+
+        Used when a response is not read to its end.
+        """
+        parts = urlparse.urlsplit(url)
+        self._connection(parts.scheme, parts.netloc, fresh=True)
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all = []
+
+
+def download_state_path(local_file_path):
+    """Return path of the sidecar file describing a partial download"""
+    return local_file_path + '.part'
+
+
+def read_download_state(local_file_path):
+    """Return state of a partial download or None if there is none"""
+    try:
+        with open(download_state_path(local_file_path)) as state_file:
+            return json.load(state_file)
+    except (IOError, ValueError):
+        return None
+
+
+def write_download_state(local_file_path, state):
+    with open(download_state_path(local_file_path), 'w') as state_file:
+        json.dump(state, state_file)
+
+
+def remove_download_state(local_file_path):
+    gscript.try_remove(download_state_path(local_file_path))
+
+
+def fetch_tile(pool, url, local_file_path, size, progress):
+    """Download one tile, continuing a partial file with a Range request
+
+    A partial file is continued only when its sidecar state belongs to the
+    same URL. The ETag or Last-Modified value stored in the state is sent
+    in If-Range so that a changed remote file is downloaded again from
+    the start. progress is called with the number of bytes of the tile
+    present locally.
+
+    The MD5 checksum is computed from the chunks as they are written and
+    compared with Content-MD5 or an MD5 ETag when the server sends one.
+    Returns a dict with the checksum and the HTTP metadata of the file.
+    """
+    CHUNK = 16 * 1024
+    headers = {}
+    offset = 0
+    state = read_download_state(local_file_path)
+    if state and state.get('url') == url and os.path.exists(local_file_path):
+        offset = os.path.getsize(local_file_path)
+    if offset:
+        headers['Range'] = 'bytes={0}-'.format(offset)
+        validator = state.get('etag') or state.get('last_modified')
+        if validator:
+            headers['If-Range'] = validator
+    try:
+        response = pool.open(url, headers=headers)
+    except DownloadError as error:
+        if error.status == 416:
+            # partial file does not fit the remote file, start over
+            remove_download_state(local_file_path)
+            gscript.try_remove(local_file_path)
+        raise
+    if response.status == 206:
+        mode = 'ab'
+    else:
+        offset = 0
+        mode = 'wb'
+    resumed_from = offset
+    write_download_state(local_file_path,
+                         {'url': url, 'size': size,
+                          'etag': response.getheader('etag'),
+                          'last_modified': response.getheader('last-modified')})
+    progress(offset)
+    digest = hashlib.md5()
+    if offset:
+        # the checksum includes the bytes of the earlier download
+        with open(local_file_path, 'rb') as partial_file:
+            for block in iter(lambda: partial_file.read(64 * CHUNK), ''):
+                digest.update(block)
+    # download files in chunks rather than write complete files to memory
+    with open(local_file_path, mode) as local_file:
+        while True:
+            chunk = response.read(CHUNK)
+            if not chunk:
+                break
+            local_file.write(chunk)
+            digest.update(chunk)
+            offset += len(chunk)
+            progress(offset)
+    # httplib does not raise when the connection closes early, the file
+    # must end where the server announced
+    content_length = response.getheader('content-length')
+    content_range = re.match(r'bytes\s+\d+-\d+/(\d+)',
+                             response.getheader('content-range') or '')
+    if mode == 'ab' and content_range:
+        expected_size = int(content_range.group(1))
+    elif content_length:
+        expected_size = resumed_from + int(content_length)
+    else:
+        expected_size = None
+    if expected_size is not None and offset != expected_size:
+        # the partial file and its state are kept for the next attempt
+        pool.reset(url)
+        raise DownloadError("Connection closed after {0} of {1} bytes".format(
+                            offset, expected_size))
+    checksum = digest.hexdigest()
+    expected = expected_md5(response, whole_file=(mode == 'wb'))
+    if expected and expected != checksum:
+        # corrupt file, next attempt downloads it from the start
+        remove_download_state(local_file_path)
+        gscript.try_remove(local_file_path)
+        raise DownloadError("MD5 checksum mismatch")
+    remove_download_state(local_file_path)
+    return {'md5': checksum, 'etag': response.getheader('etag'),
+            'http_last_modified': response.getheader('last-modified'),
+            'received': offset - resumed_from}
+
+
+def expected_md5(response, whole_file=True):
+    """Return MD5 hex digest of the remote file announced by the server
+
+    Content-MD5 applies to the response body only, so it is used when the
+    whole file was sent. Single part uploads to S3 and many other servers
+    use the MD5 of the file as ETag. Returns None if neither is present.
+    """
+    content_md5 = response.getheader('content-md5')
+    if content_md5 and whole_file:
+        try:
+            return base64.b64decode(content_md5).encode('hex')
+        except TypeError:
+            pass
+    etag = (response.getheader('etag') or '').strip('"')
+    if re.match('^[0-9a-f]{32}$', etag):
+        return etag
+    return None
+
+
+class TileDownloader(object):
+    """Pool of download threads which accepts tiles while they are listed
+
+    Tiles are distributed over max_connections worker threads, so the
+    first downloads start while later pages of the TNM API response are
+    still being read. A failed download is retried up to retries times
+    with exponential backoff, continuing from the last byte written. If
+    cache is a TileCache, each file is downloaded under the cache lock,
+    skipped when another process completed it meanwhile and added to the
+    index when complete. After a tile fails all retries no new downloads
+    are started; its partial file is kept for the next run. callback is
+    called from the worker thread with the submission index, local file
+    path and error (None on success) of each finished or skipped download.
+    """
+    def __init__(self, max_connections=1, retries=3, timeout=12, cache=None,
+                 callback=None):
+        self.retries = retries
+        self.cache = cache
+        self.callback = callback
+        self._pool = ConnectionPool(timeout=timeout)
+        self._jobs = Queue.Queue()
+        self._results = []
+        self._lock = threading.Lock()
+        self._abort = threading.Event()
+        self._progress = {'bytes': 0, 'total': 0, 'done': 0, 'pending': 0,
+                          'received': 0, 'started': None, 'finished': None,
+                          'reported': 0}
+        self._workers = []
+        for i in range(max(1, max_connections)):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._workers.append(thread)
+
+    def stop(self):
+        """Skip queued downloads and stop retrying after a failure elsewhere"""
+        self._abort.set()
+
+    def submit(self, url, local_file_path, size, last_modified=None):
+        """Queue a tile for download"""
+        with self._lock:
+            index = len(self._results)
+            self._results.append(None)
+            self._progress['total'] += size
+            self._progress['pending'] += size
+        self._jobs.put((index, (url, local_file_path, size, last_modified)))
+
+    @property
+    def pending_bytes(self):
+        """Bytes of queued tiles which are not downloaded yet"""
+        with self._lock:
+            return self._progress['pending']
+
+    def throughput(self):
+        """Return bytes received over the network and seconds spent"""
+        with self._lock:
+            if self._progress['started'] is None:
+                return 0, 0.
+            return (self._progress['received'],
+                    self._progress['finished'] - self._progress['started'])
+
+    def finish(self):
+        """Wait for all downloads and return their results
+
+        Returns a list of (local_file_path, error) pairs in the order of
+        submission where error is None for completed downloads. Tiles not
+        started because of an earlier failure are left out.
+        """
+        for thread in self._workers:
+            self._jobs.put(None)
+        for thread in self._workers:
+            thread.join()
+        self._pool.close()
+        if self._results:
+            gscript.percent(1, 1, 1)
+        return [r for r in self._results if r is not None]
+
+    def _report(self, nbytes):
+        with self._lock:
+            self._progress['bytes'] += nbytes
+            # progress is reported at most every PROGRESS_INTERVAL seconds
+            # rather than for each chunk
+            now = time.time()
+            if now - self._progress['reported'] < PROGRESS_INTERVAL:
+                return
+            self._progress['reported'] = now
+            total = self._progress['total'] or 1
+            gscript.percent(min(self._progress['bytes'], total), total, 2)
+
+    def _worker(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            index, (url, local_file_path, size, last_modified) = job
+            if self._abort.is_set():
+                if self.callback:
+                    self.callback(index, local_file_path,
+                                  DownloadError("Skipped after an earlier failure"))
+                continue
+            with self._lock:
+                if self._progress['started'] is None:
+                    self._progress['started'] = time.time()
+            tile_bytes = [0]
+
+            def tile_progress(nbytes):
+                self._report(nbytes - tile_bytes[0])
+                tile_bytes[0] = nbytes
+
+            file_name = os.path.basename(local_file_path)
+            metadata = None
+            started = time.time()
+            for attempt in range(self.retries + 1):
+                try:
+                    if self.cache is None:
+                        metadata = fetch_tile(self._pool, url, local_file_path,
+                                              size, tile_progress)
+                    elif self.cache.held(file_name):
+                        # complete and in use by this process already
+                        tile_progress(size)
+                    else:
+                        with self.cache.lock(file_name):
+                            if not self.cache.lookup(url, file_name, size,
+                                                     last_modified):
+                                metadata = fetch_tile(self._pool, url,
+                                                      local_file_path, size,
+                                                      tile_progress)
+                                self.cache.add(url, file_name, last_modified,
+                                               metadata)
+                            tile_progress(size)
+                        # kept from eviction by other processes until used
+                        if not self.cache.hold(file_name):
+                            raise DownloadError("Removed from the cache by "
+                                                "another process")
+                    error = None
+                    break
+                except (DownloadError, httplib.HTTPException,
+                        socket.error, IOError) as error:
+                    if attempt == self.retries or self._abort.is_set():
+                        break
+                    # client errors other than timeouts and throttling
+                    # or a mismatched Range will not go away by retrying
+                    status = getattr(error, 'status', None)
+                    if status and 400 <= status < 500 and status not in (408, 416, 429):
+                        break
+                    wait = min(2 ** attempt, 60)
+                    metrics.count('download_retries')
+                    gscript.verbose("Download of {0} interrupted ({1}), "
+                                    "retrying in {2} s".format(
+                                        file_name, error, wait))
+                    self._abort.wait(wait)
+            with self._lock:
+                self._results[index] = (local_file_path, error)
+                self._progress['pending'] -= size
+                self._progress['finished'] = time.time()
+                if metadata:
+                    self._progress['received'] += metadata['received']
+                    metrics.add('download', started, metadata['received'])
+                if error is None:
+                    self._progress['done'] += 1
+                    gscript.info("Download {0} of {1}: COMPLETE".format(
+                                 self._progress['done'], len(self._results)))
+                else:
+                    metrics.count('download_failures')
+                    self._abort.set()
+            if self.callback:
+                self.callback(index, local_file_path, error)
+
+
+class BlockCache(object):
+    """Blocks of remote files read with HTTP Range requests, kept on disk
+
+    Each file version gets a directory in cache_dir holding its size and
+    the blocks of block_size bytes read so far, so later reads of the
+    same bytes, also by later runs, do not use the network.
+    """
+    def __init__(self, cache_dir, block_size=256 * 1024, timeout=12):
+        self.cache_dir = cache_dir
+        self.block_size = block_size
+        self._pool = ConnectionPool(timeout=timeout)
+        self._no_ranges = set()
+
+    def _directory(self, url, version):
+        return os.path.join(self.cache_dir,
+                            hashlib.md5("{0} {1}".format(url, version)).hexdigest())
+
+    def size(self, url, version=None):
+        """Return size of a remote file or None if ranges are not supported"""
+        directory = self._directory(url, version)
+        size_path = os.path.join(directory, 'size')
+        if os.path.exists(size_path):
+            with open(size_path) as size_file:
+                return int(size_file.read())
+        netloc = urlparse.urlsplit(url).netloc
+        if netloc in self._no_ranges:
+            return None
+        response = self._pool.open(url, headers={'Range': 'bytes=0-0'})
+        content_range = response.getheader('content-range') or ''
+        match = re.match(r'bytes 0-(\d+)/(\d+)$', content_range)
+        if response.status != 206 or not match:
+            self._discard(response, url)
+            self._no_ranges.add(netloc)
+            return None
+        if match.group(1) == '0':
+            response.read()
+        else:
+            # server sent more than the requested byte
+            self._discard(response, url)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._store(size_path, match.group(2))
+        return int(match.group(2))
+
+    def _discard(self, response, url):
+        # the connection is closed instead of reading the whole file
+        response.close()
+        self._pool.reset(url)
+
+    def read(self, url, version, offset, length):
+        """Return length bytes of a remote file starting at offset"""
+        size = self.size(url, version)
+        if size is None:
+            raise DownloadError("Server does not support range requests")
+        length = max(0, min(length, size - offset))
+        if not length:
+            return ''
+        first = offset // self.block_size
+        last = (offset + length - 1) // self.block_size
+        data = ''.join(self._block(url, version, size, index)
+                       for index in range(first, last + 1))
+        start = offset - first * self.block_size
+        return data[start:start + length]
+
+    def _block(self, url, version, size, index):
+        path = os.path.join(self._directory(url, version), str(index))
+        if os.path.exists(path):
+            with open(path, 'rb') as block_file:
+                return block_file.read()
+        started = time.time()
+        start = index * self.block_size
+        end = min(start + self.block_size, size) - 1
+        response = self._pool.open(url, headers={'Range': 'bytes={0}-{1}'.format(start, end)})
+        content_range = response.getheader('content-range') or ''
+        if response.status != 206 or not content_range.startswith(
+                'bytes {0}-'.format(start)):
+            self._discard(response, url)
+            raise DownloadError("Server does not support range requests")
+        data = response.read(end - start + 1)
+        if response.getheader('content-length') != str(len(data)):
+            # server sent more than the requested range
+            self._discard(response, url)
+        if len(data) != end - start + 1:
+            raise DownloadError("Connection closed after {0} of {1} bytes".format(
+                                len(data), end - start + 1))
+        self._store(path, data)
+        metrics.add('remote_read', started, len(data))
+        return data
+
+    @staticmethod
+    def _store(path, data):
+        # readers in other threads or processes never see partial blocks
+        temp_path = "{0}.{1}.{2}".format(path, os.getpid(),
+                                         threading.current_thread().ident)
+        with open(temp_path, 'wb') as block_file:
+            block_file.write(data)
+        os.rename(temp_path, path)
+
+
+class RemoteFile(object):
+    """Read-only file object over a remote file in a BlockCache"""
+    def __init__(self, cache, url, version=None):
+        self.cache = cache
+        self.url = url
+        self.version = version
+        self.size = cache.size(url, version)
+        self._position = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += self.size
+        self._position = max(0, offset)
+
+    def tell(self):
+        return self._position
+
+    def read(self, length=-1):
+        if length < 0:
+            length = self.size - self._position
+        data = self.cache.read(self.url, self.version, self._position, length)
+        self._position += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class BlockProxy(object):
+    """Local HTTP server giving GDAL /vsicurl/ access to a BlockCache
+
+    Modules started by the module read remote tiles through this server,
+    so their range requests are served from the block cache and only
+    missing blocks are requested from the remote server.
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self._files = {}
+        proxy = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_HEAD(self):
+                self.respond(body=False)
+
+            def do_GET(self):
+                self.respond(body=True)
+
+            def respond(self, body):
+                name = self.path.lstrip('/')
+                if name not in proxy._files:
+                    self.send_error(404)
+                    return
+                url, version = proxy._files[name]
+                try:
+                    size = proxy.cache.size(url, version)
+                    if size is None:
+                        raise DownloadError("Server does not support range requests")
+                    start, end = 0, size - 1
+                    match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('range', ''))
+                    if match:
+                        start = int(match.group(1))
+                        if match.group(2):
+                            end = min(int(match.group(2)), size - 1)
+                    if start > end:
+                        self.send_response(416)
+                        self.send_header('Content-Range', 'bytes */{0}'.format(size))
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    data = proxy.cache.read(url, version, start, end - start + 1) if body else ''
+                except (DownloadError, httplib.HTTPException, socket.error, IOError):
+                    self.send_error(502)
+                    return
+                self.send_response(206 if match else 200)
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Content-Length', str(end - start + 1))
+                if match:
+                    self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                                     start, end, size))
+                self.end_headers()
+                if body:
+                    self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def register(self, url, version=None, file_name=None):
+        """Return local URL of a remote file
+
+        The local URL ends with the extension of file_name, or else of
+        the URL path, as GDAL finds archives by their extension. NLCD
+        download URLs give the file name in the query only.
+        """
+        extension = os.path.splitext(file_name or urlparse.urlsplit(url).path)[1]
+        name = hashlib.md5("{0} {1}".format(url, version)).hexdigest() + extension
+        self._files[name] = (url, version)
+        return "http://127.0.0.1:{0}/{1}".format(self._server.server_port, name)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def remote_tile_path(cache, proxy, url, version, file_name, extension, is_zip):
+    """Return GDAL path reading a remote tile through the block proxy
+
+    file_name is the name of the remote file. The member of an archive
+    is found from its central directory, read with range requests.
+    Returns None when the server does not support range requests or the
+    archive holds no tile.
+    """
+    try:
+        if cache.size(url, version) is None:
+            return None
+        local_url = proxy.register(url, version, file_name)
+        if not is_zip:
+            return "/vsicurl/" + local_url
+        with zipfile.ZipFile(RemoteFile(cache, url, version)) as remote_zip:
+            members = [f for f in remote_zip.namelist() if f.endswith(extension)]
+    except (DownloadError, httplib.HTTPException, socket.error, IOError,
+            zipfile.BadZipfile):
+        return None
+    if not members:
+        return None
+    return "/vsizip//vsicurl/{0}/{1}".format(local_url, members[-1])
+
+
+class ProcessingError(Exception):
+    pass
+
+
+class Pipeline(object):
+    """Worker threads for processing stages connected by bounded queues
+
+    stages is a list of (function, workers) pairs. Each function takes
+    an item and returns the item passed to the next stage or None to
+    drop it. The first error stops processing of all further items; the
+    queues are still drained so that producers never block. Errors other
+    than ProcessingError are recorded as ProcessingError. discard is
+    called with the failed item and each item dropped after it.
+    """
+    def __init__(self, stages, maxsize=2, discard=None):
+        self.errors = []
+        self.discard = discard
+        self._abort = threading.Event()
+        self._queues = [Queue.Queue(maxsize) for stage in stages]
+        self._stages = []
+        for i, (function, workers) in enumerate(stages):
+            threads = []
+            for j in range(max(1, workers)):
+                thread = threading.Thread(target=self._worker,
+                                          args=(function, i))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            self._stages.append(threads)
+
+    def put(self, item):
+        """Pass an item to the first stage"""
+        self._queues[0].put(item)
+
+    @property
+    def aborted(self):
+        return self._abort.is_set()
+
+    def join(self):
+        """Wait until all items passed all stages, return errors"""
+        for i, threads in enumerate(self._stages):
+            for thread in threads:
+                self._queues[i].put(None)
+            for thread in threads:
+                thread.join()
+        return self.errors
+
+    def _worker(self, function, i):
+        while True:
+            item = self._queues[i].get()
+            if item is None:
+                return
+            if self._abort.is_set():
+                if self.discard:
+                    self.discard(item)
+                continue
+            try:
+                result = function(item)
+            except (Exception, SystemExit) as error:
+                if isinstance(error, SystemExit):
+                    # gscript.fatal() printed the message already
+                    error = ProcessingError("Processing stopped by a fatal error")
+                elif not isinstance(error, ProcessingError):
+                    error = ProcessingError("{0}: {1}".format(
+                                            error.__class__.__name__, error))
+                self.errors.append(error)
+                self._abort.set()
+                if self.discard:
+                    self.discard(item)
+                continue
+            if result is not None and i + 1 < len(self._queues):
+                self._queues[i + 1].put(result)
+
+
+class ScratchBudget(object):
+    """Bytes of scratch space in use, bounded by max_bytes
+
+    acquire() blocks until the requested bytes fit into the budget. A
+    request larger than the budget is admitted when nothing else is in
+    use, so that a single large tile can still be processed.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.peak = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self._condition:
+            while self.used and self.used + nbytes > self.max_bytes:
+                self._condition.wait()
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+
+    def release(self, nbytes):
+        with self._condition:
+            self.used -= nbytes
+            self._condition.notify_all()
+
+
+def free_space(path):
+    """Return bytes available to the user in the file system of path or None"""
+    if not hasattr(os, 'statvfs'):
+        return None
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def build_vrt(vrt_path, tile_paths):
+    """Write a GDAL VRT mosaic of tiles
+
+    Where tiles overlap, the first tile in tile_paths is used, the same
+    way as r.patch prefers its first input.
+    """
+    try:
+        from osgeo import gdal
+    except ImportError:
+        gscript.fatal(_("Unable to load GDAL Python bindings (requires "
+                        "package 'python-gdal' being installed)"))
+    # later VRT sources are drawn over earlier ones
+    vrt = gdal.BuildVRT(vrt_path, list(reversed(tile_paths)))
+    if vrt is None:
+        raise ProcessingError("Unable to build VRT mosaic of tiles.")
+    # closing the dataset writes the VRT file
+    vrt = None
+
+
+def region_boundary(region, segments=16):
+    """Return points along the boundary of a region dict
+
+    Each edge is divided into segments parts, so that the boundary
+    keeps its shape when transformed to another coordinate system.
+    """
+    north, south = region['n'], region['s']
+    east, west = region['e'], region['w']
+    points = []
+    for i in range(segments):
+        points.append((west + (east - west) * i / segments, south))
+    for i in range(segments):
+        points.append((east, south + (north - south) * i / segments))
+    for i in range(segments):
+        points.append((east - (east - west) * i / segments, north))
+    for i in range(segments):
+        points.append((west, north - (north - south) * i / segments))
+    return points
+
+
+# coordinate transformations by (source, target) PROJ.4 definition,
+# the PROJ.4 definition of the location is kept under "location"
+transformers = {}
+
+
+def location_proj4():
+    """Return PROJ.4 definition of the current location"""
+    if 'location' not in transformers:
+        transformers['location'] = gscript.read_command('g.proj', flags='jf').strip()
+    return transformers['location']
+
+
+def get_transformer(proj_in, proj_out):
+    """Return OSR transformation between two PROJ.4 definitions
+
+    Transformations are created once per pair and reused.
+    """
+    key = (proj_in, proj_out)
+    if key not in transformers:
+        srs = []
+        for definition in key:
+            reference = osr.SpatialReference()
+            if reference.ImportFromProj4(definition):
+                raise ValueError("Unsupported PROJ.4 definition: " + definition)
+            # keep x, y (longitude, latitude) axis order with GDAL 3
+            if hasattr(reference, 'SetAxisMappingStrategy'):
+                reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            srs.append(reference)
+        transformers[key] = osr.CoordinateTransformation(*srs)
+    return transformers[key]
+
+
+def same_crs(proj4_a, proj4_b):
+    """Test whether two PROJ.4 definitions describe the same coordinate system
+
+    Without GDAL OSR the parameters of the definitions are compared.
+    """
+    if osr is not None:
+        references = []
+        for definition in (proj4_a, proj4_b):
+            reference = osr.SpatialReference()
+            if reference.ImportFromProj4(definition):
+                break
+            references.append(reference)
+        else:
+            return bool(references[0].IsSame(references[1]))
+    ignored = ('+no_defs', '+nodefs', '+type=crs', '+wktext')
+    return (set(p for p in proj4_a.split() if p not in ignored) ==
+            set(p for p in proj4_b.split() if p not in ignored))
+
+
+def transform_coordinates(points, proj_out, proj_in=None):
+    """Transform (x, y) points from the location or proj_in to proj_out
+
+    All points are transformed in one call, in-process with GDAL OSR when
+    available and otherwise with one m.proj call. Returns a list of
+    (x, y) float pairs, longitude and latitude in decimal degrees for
+    geographic proj_out.
+    """
+    if osr is not None:
+        try:
+            transformer = get_transformer(proj_in or location_proj4(), proj_out)
+            return [(x, y) for x, y, z in transformer.TransformPoints(points)]
+        except (ValueError, RuntimeError, TypeError) as error:
+            gscript.verbose("In-process coordinate transformation failed ({0}), "
+                            "using m.proj".format(error))
+    return transform_coordinates_m_proj(points, proj_out, proj_in)
+
+
+def transform_coordinates_m_proj(points, proj_out, proj_in=None):
+    """Transform (x, y) points from the location with one m.proj call"""
+    coordinates = "\n".join("{0!r},{1!r}".format(x, y) for x, y in points)
+    if proj_in:
+        projections = {'proj_in': proj_in, 'proj_out': proj_out}
+    else:
+        projections = {'proj_out': proj_out}
+    m_proj = gscript.start_command('m.proj', input='-', separator='comma',
+                                   flags='d', stdin=gscript.PIPE,
+                                   stdout=gscript.PIPE, **projections)
+    output = m_proj.communicate(coordinates)[0]
+    if m_proj.returncode:
+        gscript.fatal("Unable to transform region coordinates with m.proj.")
+    transformed = []
+    for line in output.splitlines():
+        if line.strip():
+            x, y = line.split(',')[:2]
+            transformed.append((float(x), float(y)))
+    return transformed
+
+
+def read_batch_regions(aoi=None, regions_file=None):
+    """Return a list of (name, region dict) pairs of areas of interest
+
+    Areas of a vector map are named by their category and cover their
+    bounding box. A regions file lists one region per line as
+    name,north,south,east,west; empty lines and lines starting with '#'
+    are ignored.
+    """
+    regions = []
+    if aoi:
+        output = gscript.read_command('v.to.db', map=aoi, option='bbox',
+                                      flags='p', separator='pipe')
+        for line in output.splitlines():
+            fields = line.split('|')
+            try:
+                cat = int(fields[0])
+                north, south, east, west = [float(x) for x in fields[1:5]]
+            except (ValueError, IndexError):
+                # header line
+                continue
+            if cat > 0:
+                regions.append((str(cat), {'n': north, 's': south,
+                                           'e': east, 'w': west}))
+    else:
+        with open(regions_file) as input_file:
+            for line in input_file:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                fields = [field.strip() for field in line.split(',')]
+                try:
+                    if len(fields) != 5:
+                        raise ValueError
+                    north, south, east, west = [float(x) for x in fields[1:]]
+                except ValueError:
+                    gscript.fatal("Invalid region in {0}: {1}".format(
+                                  regions_file, line))
+                regions.append((fields[0], {'n': north, 's': south,
+                                            'e': east, 'w': west}))
+    names = [name for name, region in regions]
+    if len(set(names)) != len(names):
+        gscript.fatal("Names of regions of interest are not unique.")
+    return regions
+
+
+def align_region(region, reference):
+    """Grow a region dict to the grid of a reference region dict"""
+    nsres, ewres = reference['nsres'], reference['ewres']
+    aligned = {'nsres': nsres, 'ewres': ewres}
+    aligned['w'] = reference['w'] + math.floor((region['w'] - reference['w']) / ewres) * ewres
+    aligned['e'] = reference['w'] + math.ceil((region['e'] - reference['w']) / ewres) * ewres
+    aligned['s'] = reference['s'] + math.floor((region['s'] - reference['s']) / nsres) * nsres
+    aligned['n'] = reference['s'] + math.ceil((region['n'] - reference['s']) / nsres) * nsres
+    return aligned
+
+
+# file in the cell_misc directory of an output listing its tiles
+IMPORT_RECORD = 'r.in.usgs.json'
+
+
+def import_record_path(name):
+    """Return path of the import record of a raster map in the current mapset"""
+    env = gscript.gisenv()
+    return os.path.join(env['GISDBASE'], env['LOCATION_NAME'], env['MAPSET'],
+                        'cell_misc', name, IMPORT_RECORD)
+
+
+def read_import_record(name):
+    """Return the import record of a raster map or None if there is none"""
+    try:
+        with open(import_record_path(name)) as record_file:
+            return json.load(record_file)
+    except (IOError, ValueError):
+        return None
+
+
+def write_import_record(name, record):
+    """Store the tiles and extent of a raster map with the map
+
+    The record is kept in the cell_misc directory of the map, so it is
+    removed and renamed together with the map. A line is also added to
+    the history of the map.
+    """
+    path = import_record_path(name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as record_file:
+        json.dump(record, record_file)
+    gscript.run_command('r.support', map=name,
+                        history="r.in.usgs: {0} tile(s) of {1}".format(
+                            len(record['tiles']), record['dataset']))
+
+
+def register_epochs(strds, maps, title):
+    """Register raster maps in a new space-time raster dataset
+
+    maps is a list of (name, start, end) with dates as ISO strings.
+    """
+    try:
+        gscript.run_command('t.create', output=strds, type='strds',
+                            temporaltype='absolute', title=title,
+                            description="Imported by r.in.usgs")
+    except CalledModuleError:
+        gscript.fatal("Unable to create space time raster dataset <{0}>".format(strds))
+    register_file = gscript.tempfile()
+    with open(register_file, 'w') as output:
+        for name, start, end in maps:
+            output.write("{0}|{1}|{2}\n".format(name, start, end))
+    try:
+        gscript.run_command('t.register', input=strds, type='raster',
+                            file=register_file)
+    except CalledModuleError:
+        gscript.fatal("Unable to register {0} map(s) in space time raster "
+                      "dataset <{1}>".format(len(maps), strds))
+    finally:
+        gscript.try_remove(register_file)
 
-import sys
-import os
-import zipfile
-import grass.script as gscript
-import urllib
-import urllib2
-import json
-import atexit
 
-from grass.exceptions import CalledModuleError
+def build_overviews(name, factors, method, env=None):
+    """Build downsampled copies of a raster map as an overview pyramid
+
+    The overview for factor N is named name_ovrN and covers the extent of
+    the map at N times its resolution. Each level is aggregated from the
+    map itself with r.resamp.stats; the mode of a coarser level is not the
+    mode of the cells of the map, and its cells do not fall on whole
+    cells of a finer level unless the factors divide each other. Returns
+    the names of the overviews.
+    """
+    info = gscript.raster_info(name)
+    names = []
+    for factor in sorted(set(factors)):
+        overview = "{0}_ovr{1}".format(name, factor)
+        overview_env = (env or os.environ).copy()
+        overview_env['GRASS_REGION'] = gscript.region_env(
+            n=info['north'], s=info['south'], e=info['east'], w=info['west'],
+            nsres=info['nsres'] * factor, ewres=info['ewres'] * factor)
+        # cells of a level do not fall on whole cells of the map
+        # if the extent is not a multiple of the factor
+        flags = 'w' if method == 'average' else ''
+        gscript.run_command('r.resamp.stats', input=name, output=overview,
+                            method=method, flags=flags, overwrite=True,
+                            env=overview_env)
+        gscript.run_command('r.colors', map=overview, raster=name,
+                            env=overview_env)
+        names.append(overview)
+    return names
+
+
+def clip_segment(x1, y1, x2, y2, west, south, east, north):
+    """Test whether a line segment intersects a rectangle (Liang-Barsky)"""
+    t0, t1 = 0., 1.
+    dx, dy = x2 - x1, y2 - y1
+    for p, q in ((-dx, x1 - west), (dx, east - x1),
+                 (-dy, y1 - south), (dy, north - y1)):
+        if p == 0:
+            if q < 0:
+                return False
+        else:
+            t = float(q) / p
+            if p < 0:
+                t0 = max(t0, t)
+            else:
+                t1 = min(t1, t)
+            if t0 > t1:
+                return False
+    return True
+
+
+class Footprint(object):
+    """Polygon covered by the region in product coordinates
+
+    Edges are indexed in vertical strips so that tests of a tile bounding
+    box only look at edges near it.
+    """
+    def __init__(self, points, strips=32):
+        xs = [x for x, y in points]
+        ys = [y for x, y in points]
+        self.west, self.east = min(xs), max(xs)
+        self.south, self.north = min(ys), max(ys)
+        self._strip_width = (self.east - self.west) / strips or 1.
+        self._strips = [[] for i in range(strips)]
+        for i in range(len(points)):
+            x1, y1 = points[i]
+            x2, y2 = points[(i + 1) % len(points)]
+            first, last = self._strip_range(min(x1, x2), max(x1, x2))
+            for strip in range(first, last + 1):
+                self._strips[strip].append((x1, y1, x2, y2))
+
+    def _strip_range(self, west, east):
+        last_strip = len(self._strips) - 1
+        first = int((west - self.west) / self._strip_width)
+        last = int((east - self.west) / self._strip_width)
+        return max(0, min(first, last_strip)), max(0, min(last, last_strip))
+
+    def contains(self, x, y):
+        """Test whether a point lies inside the polygon"""
+        if not (self.west <= x <= self.east and self.south <= y <= self.north):
+            return False
+        strip = self._strip_range(x, x)[0]
+        inside = False
+        for x1, y1, x2, y2 in self._strips[strip]:
+            # count crossings of a ray going north from the point
+            if (x1 <= x) != (x2 <= x):
+                if y1 + (x - x1) * (y2 - y1) / (x2 - x1) > y:
+                    inside = not inside
+        return inside
+
+    def covers(self, bounding_box):
+        """Test whether a TNM item boundingBox dict lies within the polygon"""
+        if not bounding_box:
+            return False
+        west, east = bounding_box['minX'], bounding_box['maxX']
+        south, north = bounding_box['minY'], bounding_box['maxY']
+        return all(self.contains(x, y) for x, y in
+                   ((west, south), (west, north), (east, south), (east, north)))
+
+    def coverage(self, bounding_boxes, samples=16):
+        """Return the fraction of the polygon within TNM item boundingBox dicts
+
+        The fraction is estimated on a grid of samples x samples points.
+        """
+        width = float(self.east - self.west) / samples
+        height = float(self.north - self.south) / samples
+        points = [(self.west + (i + 0.5) * width, self.south + (j + 0.5) * height)
+                  for i in range(samples) for j in range(samples)]
+        points = ([(x, y) for x, y in points if self.contains(x, y)] or
+                  [((self.west + self.east) / 2., (self.south + self.north) / 2.)])
+        covered = 0
+        for x, y in points:
+            if any(box['minX'] <= x <= box['maxX'] and box['minY'] <= y <= box['maxY']
+                   for box in bounding_boxes):
+                covered += 1
+        return float(covered) / len(points)
+
+    def intersects(self, bounding_box):
+        """Test a TNM item boundingBox dict against the polygon"""
+        if not bounding_box:
+            return True
+        west, east = bounding_box['minX'], bounding_box['maxX']
+        south, north = bounding_box['minY'], bounding_box['maxY']
+        if (west > self.east or east < self.west or
+                south > self.north or north < self.south):
+            return False
+        for x, y in ((west, south), (west, north), (east, south), (east, north)):
+            if self.contains(x, y):
+                return True
+        first, last = self._strip_range(west, east)
+        for strip in range(first, last + 1):
+            for edge in self._strips[strip]:
+                if clip_segment(*(edge + (west, south, east, north))):
+                    return True
+        return False
+
+
+def file_crc32(path):
+    """Return CRC-32 checksum of a file as computed by zipfile"""
+    crc = 0
+    with open(path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1024 * 1024), ''):
+            crc = zlib.crc32(block, crc)
+    return crc & 0xffffffff
+
+
+def extract_member(read_zip, info, directory):
+    """Extract a member of an open ZIP archive unless it is extracted already
+
+    An existing file is kept when its size and CRC-32 match the member.
+    Otherwise the member is written to a temporary file which is renamed
+    when complete, so an interrupted extraction is never taken for a
+    complete one. Returns the path and whether the member was extracted.
+    """
+    path = os.path.join(directory, info.filename)
+    if (os.path.exists(path) and os.path.getsize(path) == info.file_size and
+            file_crc32(path) == info.CRC):
+        return path, False
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    temp_path = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        with read_zip.open(info) as member, open(temp_path, 'wb') as output:
+            shutil.copyfileobj(member, output, 1024 * 1024)
+        os.rename(temp_path, path)
+    finally:
+        gscript.try_remove(temp_path)
+    return path, True
+
+
+def extracted_size(zip_path, extension):
+    """Return uncompressed size of the tiles in a ZIP archive or None
+
+    Only the archive directory is read.
+    """
+    try:
+        with zipfile.ZipFile(zip_path, "r") as read_zip:
+            return sum(info.file_size for info in read_zip.infolist()
+                       if info.filename.endswith(extension))
+    except (zipfile.BadZipfile, IOError):
+        return None
+
+
+# uncompressed to compressed size of tiles when no tile is cached yet
+EXTRACTED_SIZE_RATIO = 2.0
+
+# fields of TNM API items used by the module, other fields are dropped
+TNM_ITEM_FIELDS = ('title', 'downloadURL', 'sizeInBytes', 'lastUpdated',
+                   'boundingBox', 'datasets')
+
+
+def format_size(size):
+    """Format a number of bytes in KB, MB or GB"""
+    if len(str(size)) <= 6:
+        return "{0:.2f} KB".format(size * 1e-3)
+    if len(str(size)) < 10:
+        return "{0:.2f} MB".format(size * 1e-6)
+    return "{0:.2f} GB".format(size * 1e-9)
+
+
+def query_TNM(url, page_size=100, timeout=12):
+    """Query the TNM API and yield (total, items) for each page of results
+
+    Pages are requested with offset and max over one kept-alive
+    connection and parsed one at a time, so only a single page of the
+    response is held in memory.
+    """
+    pool = ConnectionPool(timeout=timeout)
+    offset = 0
+    try:
+        while True:
+            page_url = "{0}&offset={1}&max={2}".format(url, offset, page_size)
+            try:
+                started = time.time()
+                body = pool.open(page_url).read()
+                metrics.add('query', started, len(body))
+                page = json.loads(body)
+            except (DownloadError, httplib.HTTPException, socket.error):
+                gscript.fatal("USGS TNM API query has timed out. Check network configuration. Please try again.")
+            except ValueError:
+                gscript.fatal("Unable to load USGS JSON object.")
+            if page.get('errors'):
+                api_error_msg = "TNM API Error - {0}".format(str(page['errors']))
+                gscript.fatal(api_error_msg)
+            items = [dict((key, item[key]) for key in TNM_ITEM_FIELDS
+                          if key in item) for item in page['items']]
+            total = int(page['total'])
+            yield total, items
+            offset += len(items)
+            if not items or offset >= total:
+                break
+    finally:
+        pool.close()
+
+
+class CacheIndex(object):
+    """SQLite index in a cache directory shared by r.in.usgs processes
+
+    Items are written under an exclusive file lock. A process using an
+    item holds a shared lock on it, and items are only evicted when the
+    exclusive lock can be taken without waiting.
+    """
+    INDEX = 'r.in.usgs.cache.sqlite'
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._held = {}
+        self._held_lock = threading.Lock()
+        # lock files are kept apart from the cached items
+        try:
+            os.makedirs(os.path.join(cache_dir, 'locks'))
+        except OSError:
+            if not os.path.isdir(os.path.join(cache_dir, 'locks')):
+                raise
+        self._db = sqlite3.connect(os.path.join(cache_dir, self.INDEX),
+                                   timeout=60, isolation_level=None,
+                                   check_same_thread=False)
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._db.execute(sql, parameters).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+        for name in list(self._held):
+            self.release(name)
+
+    def _lock_path(self, name):
+        return os.path.join(self.cache_dir, 'locks', name + '.lock')
+
+    def _open_lock(self, name, operation):
+        """Open the lock file of an item and lock it with flock operation
+
+        Lock files are removed together with their items, so a lock taken
+        on a file removed meanwhile is taken again on the current file.
+        Returns the open file, or None if a non-blocking lock is held by
+        another process.
+        """
+        path = self._lock_path(name)
+        while True:
+            lock_file = open(path, 'a')
+            if fcntl is None:
+                return lock_file
+            try:
+                fcntl.flock(lock_file, operation)
+            except IOError:
+                lock_file.close()
+                return None
+            try:
+                if os.fstat(lock_file.fileno()).st_ino == os.stat(path).st_ino:
+                    return lock_file
+            except OSError:
+                pass
+            lock_file.close()
+
+    @contextmanager
+    def lock(self, name):
+        """Hold an exclusive lock on a cached item across processes"""
+        if fcntl is None:
+            yield
+            return
+        lock_file = self._open_lock(name, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            lock_file.close()
+
+    def hold(self, name):
+        """Hold a shared lock on a cached item until it is released
+
+        The item may have been evicted before the lock was taken, so the
+        caller checks it again.
+        """
+        with self._held_lock:
+            if name in self._held or fcntl is None:
+                return
+            self._held[name] = self._open_lock(name, fcntl.LOCK_SH)
+
+    def held(self, name):
+        """Test whether this process holds an item"""
+        return name in self._held
+
+    def release(self, name):
+        with self._held_lock:
+            lock_file = self._held.pop(name, None)
+        if lock_file:
+            lock_file.close()
+
+    def try_lock(self, name):
+        """Take an exclusive lock on a cached item without waiting
+
+        Returns the open lock file, which is closed to release the lock,
+        or None if any process holds or writes the item.
+        """
+        return self._open_lock(name, fcntl.LOCK_EX | fcntl.LOCK_NB
+                               if fcntl is not None else None)
+
+    def remove_lock(self, name, lock_file):
+        """Remove the lock file of a removed item and release its lock
+
+        lock_file is the file returned by try_lock().
+        """
+        gscript.try_remove(self._lock_path(name))
+        lock_file.close()
+
+
+def bbox_intersects(bounding_box, bbox):
+    """Test TNM item boundingBox dict against (west, south, east, north)"""
+    if not bounding_box:
+        return True
+    west, south, east, north = bbox
+    return (bounding_box['minX'] <= east and bounding_box['maxX'] >= west and
+            bounding_box['minY'] <= north and bounding_box['maxY'] >= south)
+
+
+class QueryCache(CacheIndex):
+    """Parsed TNM API responses reused for a limited time
+
+    Listings are stored with the query parameters other than the bbox
+    as key, one API page at a time, so a listing is never held in memory
+    as a whole while it is stored. A listing is used once all its pages
+    are stored. A later query with the same key whose bbox lies within a
+    cached bbox is answered from the cached items which intersect it.
+    """
+    def __init__(self, cache_dir, ttl):
+        CacheIndex.__init__(self, cache_dir)
+        self.ttl = ttl
+        # listings of older versions were stored in one row
+        self._execute("DROP TABLE IF EXISTS queries")
+        self._execute("CREATE TABLE IF NOT EXISTS listings ("
+                      "id INTEGER PRIMARY KEY, "
+                      "key TEXT NOT NULL, "
+                      "west REAL, south REAL, east REAL, north REAL, "
+                      "created REAL NOT NULL, "
+                      "total INTEGER)")
+        self._execute("CREATE TABLE IF NOT EXISTS listing_pages ("
+                      "listing INTEGER NOT NULL, "
+                      "page INTEGER NOT NULL, "
+                      "items TEXT NOT NULL)")
+
+    def lookup(self, key, bbox):
+        """Return cached response for bbox or None"""
+        if not self.ttl:
+            return None
+        west, south, east, north = bbox
+        rows = self._execute("SELECT id FROM listings WHERE key = ? "
+                             "AND total IS NOT NULL "
+                             "AND created >= ? AND west <= ? AND south <= ? "
+                             "AND east >= ? AND north >= ? "
+                             "ORDER BY created DESC LIMIT 1",
+                             (key, time.time() - self.ttl,
+                              west, south, east, north))
+        if not rows:
+            return None
+        items = []
+        page = 0
+        while True:
+            pages = self._execute("SELECT items FROM listing_pages "
+                                  "WHERE listing = ? AND page = ?",
+                                  (rows[0][0], page))
+            if not pages:
+                break
+            items.extend(item for item in json.loads(pages[0][0])
+                         if bbox_intersects(item.get('boundingBox'), bbox))
+            page += 1
+        return {'total': len(items), 'items': items, 'errors': []}
+
+    def open_listing(self, key, bbox):
+        """Start storing a listing, return its id or None without ttl"""
+        if not self.ttl:
+            return None
+        expired = time.time() - self.ttl
+        self._execute("DELETE FROM listing_pages WHERE listing IN "
+                      "(SELECT id FROM listings WHERE created < ?)", (expired,))
+        self._execute("DELETE FROM listings WHERE created < ?", (expired,))
+        with self._lock:
+            return self._db.execute(
+                "INSERT INTO listings (key, west, south, east, north, created) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key,) + tuple(bbox) + (time.time(),)).lastrowid
+
+    def add_page(self, listing, page, items):
+        """Store the items of page number page of a listing"""
+        self._execute("INSERT INTO listing_pages VALUES (?, ?, ?)",
+                      (listing, page, json.dumps(items)))
+
+    def close_listing(self, listing, total):
+        """Mark a listing of total items as complete"""
+        self._execute("UPDATE listings SET total = ? WHERE id = ?",
+                      (total, listing))
+
+    def store(self, key, bbox, response):
+        """Store a whole response"""
+        listing = self.open_listing(key, bbox)
+        if listing is None:
+            return
+        self.add_page(listing, 0, response['items'])
+        self.close_listing(listing, len(response['items']))
+
+
+class TileCache(CacheIndex):
+    """Download cache shared by r.in.usgs processes
+
+    Downloaded files are kept in cache_dir and indexed in an SQLite
+    database by their TNM download URL together with their size, the TNM
+    last update date and the time of last access. When max_bytes is set,
+    least recently used files are evicted to keep the cache within the
+    budget. The index is accessed in transactions and downloads of the
+    same tile are serialized with file locks, so several processes can
+    share one cache.
+    """
+    def __init__(self, cache_dir, max_bytes=0, tolerance=5):
+        CacheIndex.__init__(self, cache_dir)
+        self.max_bytes = max_bytes
+        self.tolerance = tolerance
+        self._execute("CREATE TABLE IF NOT EXISTS tiles ("
+                      "url TEXT PRIMARY KEY, "
+                      "name TEXT NOT NULL, "
+                      "size INTEGER NOT NULL, "
+                      "last_modified TEXT, "
+                      "last_access REAL NOT NULL)")
+        # checksum and HTTP metadata recorded when the file was downloaded
+        columns = [row[1] for row in self._execute("PRAGMA table_info(tiles)")]
+        for column in ('md5', 'etag', 'http_last_modified'):
+            if column not in columns:
+                self._execute("ALTER TABLE tiles ADD COLUMN {0} TEXT".format(column))
+        self._execute("CREATE TABLE IF NOT EXISTS throughput ("
+                      "time REAL NOT NULL, "
+                      "bytes INTEGER NOT NULL, "
+                      "seconds REAL NOT NULL)")
+        # time spent per unit of work by extraction, import and patching
+        self._execute("CREATE TABLE IF NOT EXISTS stage_times ("
+                      "time REAL NOT NULL, "
+                      "stage TEXT NOT NULL, "
+                      "units REAL NOT NULL, "
+                      "seconds REAL NOT NULL)")
+
+    def path(self, file_name):
+        return os.path.join(self.cache_dir, file_name)
+
+    def lookup(self, url, file_name, size, last_modified=None):
+        """Return True if a complete and current copy of url is cached
+
+        Only the index and the file size are checked, the file is not
+        read; its checksum was verified while it was downloaded. A complete
+        file found in cache_dir but missing in the index, e.g. downloaded
+        by an older version of the module, is added to it.
+        """
+        path = self.path(file_name)
+        rows = self._execute("SELECT last_modified, size FROM tiles WHERE url = ?",
+                             (url,))
+        if (not os.path.exists(path) or read_download_state(path) or
+                abs(os.path.getsize(path) - size) > self.tolerance or
+                (rows and os.path.getsize(path) != rows[0][1])):
+            if rows:
+                self._execute("DELETE FROM tiles WHERE url = ?", (url,))
+            return False
+        if rows and last_modified and rows[0][0] not in (None, last_modified):
+            # tile was updated by USGS since it was downloaded
+            return False
+        if rows:
+            self._execute("UPDATE tiles SET last_access = ? WHERE url = ?",
+                          (time.time(), url))
+        else:
+            self.add(url, file_name, last_modified)
+        return True
+
+    def add(self, url, file_name, last_modified=None, metadata=None):
+        """Record a complete file in the index
+
+        metadata is the dict returned by fetch_tile().
+        """
+        metadata = metadata or {}
+        self._execute("INSERT OR REPLACE INTO tiles (url, name, size, "
+                      "last_modified, last_access, md5, etag, "
+                      "http_last_modified) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                      (url, file_name, os.path.getsize(self.path(file_name)),
+                       last_modified, time.time(), metadata.get('md5'),
+                       metadata.get('etag'),
+                       metadata.get('http_last_modified')))
+
+    def hold(self, file_name):
+        """Hold a cached file, return False if it was evicted meanwhile"""
+        CacheIndex.hold(self, file_name)
+        if os.path.exists(self.path(file_name)):
+            return True
+        self.release(file_name)
+        return False
+
+    def remove(self, file_name):
+        """Remove a cached file and its index entry
+
+        The file is kept if another process uses it. Returns True if it
+        was removed.
+        """
+        self.release(file_name)
+        lock_file = self.try_lock(file_name)
+        if lock_file is None:
+            return False
+        gscript.try_remove(self.path(file_name))
+        self._execute("DELETE FROM tiles WHERE name = ?", (file_name,))
+        self.remove_lock(file_name, lock_file)
+        return True
+
+    def record_throughput(self, nbytes, seconds):
+        """Record bytes downloaded by one run and the time it took"""
+        if nbytes and seconds > 0:
+            self._execute("INSERT INTO throughput VALUES (?, ?, ?)",
+                          (time.time(), nbytes, seconds))
+
+    def throughput(self, runs=10):
+        """Return download speed in bytes per second of recent runs or None"""
+        rows = self._execute("SELECT SUM(bytes), SUM(seconds) FROM "
+                             "(SELECT bytes, seconds FROM throughput "
+                             "ORDER BY time DESC LIMIT ?)", (runs,))
+        if not rows or not rows[0][1]:
+            return None
+        return rows[0][0] / rows[0][1]
+
+    def record_stage(self, stage, units, seconds):
+        """Record units of work done by a stage in one run and the time it took"""
+        if units and seconds > 0:
+            self._execute("INSERT INTO stage_times VALUES (?, ?, ?, ?)",
+                          (time.time(), stage, units, seconds))
+
+    def stage_rate(self, stage, runs=10):
+        """Return seconds per unit of work of a stage in recent runs or None"""
+        rows = self._execute("SELECT SUM(units), SUM(seconds) FROM "
+                             "(SELECT units, seconds FROM stage_times "
+                             "WHERE stage = ? ORDER BY time DESC LIMIT ?)",
+                             (stage, runs))
+        if not rows or not rows[0][0]:
+            return None
+        return rows[0][1] / rows[0][0]
+
+    def evict(self, keep=(), reserve=0):
+        """Remove least recently used files until the cache fits its budget
+
+        Files of URLs in keep and files in use by any process are not
+        removed. reserve is the number of bytes about to be added to the
+        cache. Returns removed file names.
+        """
+        removed = []
+        if not self.max_bytes:
+            return removed
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute("SELECT url, name, size FROM tiles "
+                                        "ORDER BY last_access").fetchall()
+                total = sum(row[2] for row in rows) + reserve
+                for url, file_name, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    if url in keep:
+                        continue
+                    lock_file = self.try_lock(file_name)
+                    if lock_file is None:
+                        continue
+                    try:
+                        gscript.try_remove(self.path(file_name))
+                        remove_download_state(self.path(file_name))
+                    finally:
+                        self.remove_lock(file_name, lock_file)
+                    self._db.execute("DELETE FROM tiles WHERE url = ?", (url,))
+                    total -= size
+                    removed.append(file_name)
+                self._db.execute("COMMIT")
+            except sqlite3.Error:
+                self._db.execute("ROLLBACK")
+                raise
+        return removed
+
+
+class ImportCache(CacheIndex):
+    """Reprojected tiles kept as raster maps in a cache mapset
+
+    Maps are named by a hash of the tile and of the import parameters
+    and indexed with their size and time of last access. Modules writing
+    to the cache mapset run with their own gisrc file, so the current
+    mapset of the session is not changed. When max_bytes is set, least
+    recently used maps are removed to keep the cache within the budget.
+    """
+    INDEX = 'r.in.usgs.imports.sqlite'
+
+    def __init__(self, mapset, max_bytes=0):
+        gisenv = gscript.gisenv()
+        self.mapset = mapset
+        self.max_bytes = max_bytes
+        location_path = os.path.join(gisenv['GISDBASE'], gisenv['LOCATION_NAME'])
+        mapset_path = os.path.join(location_path, mapset)
+        # the mapset is created from the default region of the location
+        # without g.mapset, which would switch and lock a session
+        if not os.path.exists(os.path.join(mapset_path, 'WIND')):
+            try:
+                if not os.path.isdir(mapset_path):
+                    os.makedirs(mapset_path)
+            except OSError:
+                # created by another process meanwhile
+                if not os.path.isdir(mapset_path):
+                    raise
+            wind_path = os.path.join(mapset_path, 'WIND.{0}'.format(os.getpid()))
+            shutil.copyfile(os.path.join(location_path, 'PERMANENT', 'DEFAULT_WIND'),
+                            wind_path)
+            os.rename(wind_path, os.path.join(mapset_path, 'WIND'))
+        self.env = os.environ.copy()
+        self.env['GISRC'] = gscript.tempfile()
+        cleanup_list.append(self.env['GISRC'])
+        with open(self.env['GISRC'], 'w') as gisrc:
+            for key in ('GISDBASE', 'LOCATION_NAME'):
+                gisrc.write("{0}: {1}\n".format(key, gisenv[key]))
+            gisrc.write("MAPSET: {0}\n".format(mapset))
+        CacheIndex.__init__(self, mapset_path)
+        self._execute("CREATE TABLE IF NOT EXISTS imports ("
+                      "name TEXT PRIMARY KEY, "
+                      "size INTEGER NOT NULL, "
+                      "last_access REAL NOT NULL)")
+
+    @staticmethod
+    def name(key):
+        """Return map name for a dict of tile and import parameters"""
+        digest = hashlib.md5(json.dumps(key, sort_keys=True)).hexdigest()
+        return 'usgs_' + digest[:20]
+
+    def _size(self, name):
+        size = 0
+        for element in ('cell', 'fcell', 'cellhd'):
+            path = os.path.join(self.cache_dir, element, name)
+            if os.path.exists(path):
+                size += os.path.getsize(path)
+        misc_dir = os.path.join(self.cache_dir, 'cell_misc', name)
+        if os.path.isdir(misc_dir):
+            size += sum(os.path.getsize(os.path.join(misc_dir, f))
+                        for f in os.listdir(misc_dir))
+        return size
+
+    def lookup(self, name):
+        """Return fully qualified name of a cached map or None"""
+        rows = self._execute("SELECT name FROM imports WHERE name = ?", (name,))
+        if not rows:
+            return None
+        if not os.path.exists(os.path.join(self.cache_dir, 'cellhd', name)):
+            self._execute("DELETE FROM imports WHERE name = ?", (name,))
+            return None
+        self._execute("UPDATE imports SET last_access = ? WHERE name = ?",
+                      (time.time(), name))
+        return "{0}@{1}".format(name, self.mapset)
+
+    def hold(self, name):
+        """Hold a cached map, return False if it was evicted meanwhile"""
+        CacheIndex.hold(self, name)
+        if os.path.exists(os.path.join(self.cache_dir, 'cellhd', name)):
+            return True
+        self.release(name)
+        return False
+
+    def add(self, name):
+        """Record a map imported into the cache mapset"""
+        self._execute("INSERT OR REPLACE INTO imports VALUES (?, ?, ?)",
+                      (name, self._size(name), time.time()))
+        return "{0}@{1}".format(name, self.mapset)
+
+    def evict(self, keep=()):
+        """Remove least recently used maps until the cache fits its budget
+
+        Maps in keep and maps in use by any process are not removed.
+        Returns names of removed maps.
+        """
+        removed = []
+        if not self.max_bytes:
+            return removed
+        rows = self._execute("SELECT name, size FROM imports ORDER BY last_access")
+        total = sum(row[1] for row in rows)
+        lock_files = {}
+        try:
+            for name, size in rows:
+                if total <= self.max_bytes:
+                    break
+                if name in keep:
+                    continue
+                lock_file = self.try_lock(name)
+                if lock_file is None:
+                    continue
+                lock_files[name] = lock_file
+                removed.append(name)
+                total -= size
+            if removed:
+                gscript.run_command('g.remove', type='raster', name=removed,
+                                    flags='f', quiet=True, env=self.env)
+                for name in removed:
+                    self._execute("DELETE FROM imports WHERE name = ?", (name,))
+                    self.remove_lock(name, lock_files.pop(name))
+        finally:
+            for lock_file in lock_files.values():
+                lock_file.close()
+        return removed
 
-cleanup_list = []
 
 def main():
     # Hard-coded parameters needed for USGS datasets
@@ -239,32 +2341,37 @@ def main():
     gui_subset = None
 
     # Parameter assignments for each dataset
+    ned_abbreviations = {'1 arc-second': 'ned_1arc_',
+                         '1/3 arc-second': 'ned_13arc_',
+                         '1/9 arc-second': 'ned_19arc_'}
     if gui_product == 'ned':
         gui_dataset = options['ned_dataset']
-        product_tag = product + " " + gui_dataset
-        if options['ned_dataset'] == '1 arc-second':
-            ned_data_abbrv = 'ned_1arc_'
-        if options['ned_dataset'] == '1/3 arc-second':
-            ned_data_abbrv = 'ned_13arc_'
-        if options['ned_dataset'] == '1/9 arc-second':
-            ned_data_abbrv = 'ned_19arc_'
+        # 'auto' is resolved once the region and the available tiles are known
+        if gui_dataset != 'auto':
+            product_tag = product + " " + gui_dataset
+            ned_data_abbrv = ned_abbreviations[gui_dataset]
 
+    # NLCD epochs, one output for each combination of dataset and subset
+    nlcd_epochs = None
     if gui_product == 'nlcd':
-        gui_dataset = options['nlcd_dataset']
-        if options['nlcd_dataset'] == 'nlcd2001':
-            gui_dataset = 'National Land Cover Database (NLCD) - 2001'
-        if options['nlcd_dataset'] == 'nlcd2006':
-            gui_dataset = 'National Land Cover Database (NLCD) - 2006'
-        if options['nlcd_dataset'] == 'nlcd2011':
-            gui_dataset = 'National Land Cover Database (NLCD) - 2011'
-        
-        if options['nlcd_subset'] == 'land_cover':
-            gui_subset = 'Land Cover'
-        if options['nlcd_subset'] == 'impervious':
-            gui_subset = 'Percent Developed Imperviousness'
-        if options['nlcd_subset'] == 'canopy':
-            gui_subset = 'Percent Tree Canopy'
+        nlcd_datasets = {'nlcd2001': 'National Land Cover Database (NLCD) - 2001',
+                         'nlcd2006': 'National Land Cover Database (NLCD) - 2006',
+                         'nlcd2011': 'National Land Cover Database (NLCD) - 2011'}
+        nlcd_subsets = {'land_cover': 'Land Cover',
+                        'impervious': 'Percent Developed Imperviousness',
+                        'canopy': 'Percent Tree Canopy'}
+        epochs = [(dataset, subset) for dataset in options['nlcd_dataset'].split(',')
+                  for subset in options['nlcd_subset'].split(',')]
+        gui_dataset = nlcd_datasets[epochs[0][0]]
+        gui_subset = nlcd_subsets[epochs[0][1]]
         product_tag = gui_dataset
+        if len(epochs) > 1:
+            # (name, dataset, subset title, subset, year)
+            nlcd_epochs = [("{0}_{1}".format(dataset, subset), nlcd_datasets[dataset],
+                            nlcd_subsets[subset], subset, int(dataset[4:]))
+                           for dataset, subset in epochs]
+            product_tag = ",".join(sorted(set(epoch[1] for epoch in nlcd_epochs)))
+            gui_subset = ", ".join(sorted(set(epoch[2] for epoch in nlcd_epochs)))
 
     if gui_product == 'naip':
         gui_dataset = options['naip_dataset']
@@ -279,75 +2386,591 @@ def main():
     gui_resampling_method = options['resampling_method']
     gui_i_flag = flags['i']
     gui_k_flag = flags['k']
+    gui_z_flag = flags['z']
+    gui_plan = options['plan']
+    gui_m_flag = flags['m']
+    gui_u_flag = flags['u']
+    gui_l_flag = flags['l']
+    gui_r_flag = flags['r']
+    gui_max_connections = int(options['max_connections'])
+    gui_retries = int(options['retries'])
+    gui_nprocs = int(options['nprocs'])
     work_dir = options['output_directory']
+    cache_dir = options['cache_dir'] or work_dir
+    cache_size = int(options['cache_size']) * 1024 * 1024
+    query_ttl = float(options['query_ttl']) * 3600
+    gui_aoi = options['aoi']
+    gui_import_cache = options['import_cache']
+    if options['scratch_size']:
+        scratch_budget = ScratchBudget(int(options['scratch_size']) * 1024 * 1024)
+    else:
+        scratch_budget = None
+    import_cache_size = int(options['import_cache_size']) * 1024 * 1024
+    gui_regions = options['regions']
+    # continuous products are averaged, classes take the most frequent value
+    if options['overviews']:
+        overview_factors = [int(factor) for factor in options['overviews'].split(',')]
+        if min(overview_factors) < 2:
+            gscript.fatal("Overview factors must be 2 or larger.")
+        overview_method = 'average' if product_interpolation == 'bilinear' else 'mode'
+    else:
+        overview_factors = None
+
+    # metrics are written also when the run fails
+    if options['metrics']:
+        metrics.labels = {'product': gui_product, 'output': gui_output_layer}
+        atexit.register(metrics.write, options['metrics'],
+                        options['metrics_format'])
 
     # Returns current units
     try:
         proj = gscript.parse_command('g.proj', flags='g')
         if gscript.locn_is_latlong():
-            product_resolution = nav_string['dataset'][gui_dataset][0]
+            resolution_index = 0
         elif float(proj['meters']) == 1:
-            product_resolution = nav_string['dataset'][gui_dataset][1]
+            resolution_index = 1
         else:
             # we assume feet
-            product_resolution = nav_string['dataset'][gui_dataset][2]
+            resolution_index = 2
     except TypeError:
+        resolution_index = None
+
+    def dataset_resolution(dataset):
+        """Resolution of a dataset in the units of the location"""
+        if resolution_index is None:
+            return False
+        return nav_string['dataset'][dataset][resolution_index]
+
+    if gui_dataset == 'auto':
+        if resolution_index is None:
+            gscript.fatal("Units of the location are unknown, select a NED dataset "
+                          "instead of auto.")
         product_resolution = False
+    else:
+        product_resolution = dataset_resolution(gui_dataset)
+
+    # tiles in the coordinate system of the location need no reprojection
+    # and are linked instead of imported
+    link_tiles = False
+    if gui_l_flag:
+        if same_crs(location_proj4(), product_proj4):
+            link_tiles = True
+        else:
+            gscript.warning("Coordinate system of the location differs from "
+                            "the one of the product, tiles are imported.")
 
     if gui_resampling_method == 'default':
         gui_resampling_method = nav_string['interpolation']
         gscript.verbose(_("The default resampling method for product {product} is {res}").format(product=gui_product,
                         res=product_interpolation))
 
-    # Get coordinates for current GRASS computational region and convert to USGS SRS
+    # Get boundary of current GRASS computational region and convert to USGS SRS
     gregion = gscript.region()
-    min_coords = gscript.read_command('m.proj', coordinates=(gregion['w'], gregion['s']),
-                                                proj_out=product_proj4, separator='comma',
-                                                flags='d')
-    max_coords = gscript.read_command('m.proj', coordinates=(gregion['e'], gregion['n']),
-                                                proj_out=product_proj4, separator='comma',
-                                                flags='d')
-    min_list = min_coords.split(',')[:2]
-    max_list = max_coords.split(',')[:2]
-    list_bbox = min_list + max_list
-    str_bbox = ",".join((str(coord) for coord in list_bbox))
+    if gui_aoi or gui_regions:
+        # batch mode, areas of interest aligned to the current region
+        batch_regions = [(name, align_region(region, gregion)) for name, region
+                         in read_batch_regions(gui_aoi, gui_regions)]
+        if not batch_regions:
+            gscript.fatal("No areas of interest found.")
+    else:
+        batch_regions = None
+    areas = [region for name, region in batch_regions or [(None, gregion)]]
+    # outputs of batch mode, one for each area of interest and NLCD epoch,
+    # output i * len(areas) + j is epoch i in area j
+    if nlcd_epochs:
+        if gui_u_flag or gui_l_flag or options['scratch_size']:
+            gscript.fatal("Flags -u and -l and option scratch_size cannot be used "
+                          "with several NLCD datasets or subsets.")
+        batch_outputs = [("{0}_{1}".format(epoch[0], name) if name else epoch[0], region)
+                         for epoch in nlcd_epochs
+                         for name, region in batch_regions or [(None, gregion)]]
+    else:
+        batch_outputs = batch_regions
+    # boundaries of all areas are transformed in one call
+    boundaries = [region_boundary(region) for region in areas]
+    points = transform_coordinates([point for boundary in boundaries
+                                    for point in boundary], product_proj4)
+    footprints = []
+    for boundary in boundaries:
+        footprints.append(Footprint(points[:len(boundary)]))
+        points = points[len(boundary):]
+    list_bbox = [min(area.west for area in footprints),
+                 min(area.south for area in footprints),
+                 max(area.east for area in footprints),
+                 max(area.north for area in footprints)]
+    str_bbox = ",".join((repr(coord) for coord in list_bbox))
 
     # Format variables for TNM API call
-    gui_prod_str = str(product_tag)
-    datasets = urllib.quote_plus(gui_prod_str)
     prod_format = urllib.quote_plus(product_format)
     prod_extent = urllib.quote_plus(product_extent[0])
-
-    # Create TNM API URL
-    base_TNM = "https://viewer.nationalmap.gov/tnmaccess/api/products?"
-    datasets_TNM = "datasets={0}".format(datasets)
+    base_TNM = TNM_API_BASE_URL
     bbox_TNM = "&bbox={0}".format(str_bbox)
     prod_format_TNM = "&prodFormats={0}".format(prod_format)
-    TNM_API_URL = base_TNM + datasets_TNM + bbox_TNM + prod_format_TNM
-    if gui_product == 'nlcd':
-        TNM_API_URL += "&prodExtents={0}".format(prod_extent)
 
+    def TNM_query_url(tag):
+        """Create TNM API URL for a dataset"""
+        datasets = urllib.quote_plus(str(tag))
+        datasets_TNM = "datasets={0}".format(datasets)
+        url = base_TNM + datasets_TNM + bbox_TNM + prod_format_TNM
+        if gui_product == 'nlcd':
+            url += "&prodExtents={0}".format(prod_extent)
+        return url
+
+    # Reuse a cached response for an enclosing bbox if there is one
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    query_cache = QueryCache(cache_dir, ttl=query_ttl)
+    query_bbox = [float(coord) for coord in list_bbox]
+
+    # with auto, each NED dataset is queried and the coarsest one meeting
+    # the region resolution which has tiles for all areas is selected
+    dataset_survey = None
+    surveyed_items = {}
+    if gui_dataset == 'auto':
+        region_resolution = min(gregion['nsres'], gregion['ewres'])
+        dataset_survey = []
+        for dataset in sorted(nav_string['dataset'], key=dataset_resolution,
+                              reverse=True):
+            survey_url = TNM_query_url(product + " " + dataset)
+            gscript.verbose("TNM API Query URL:\t{0}".format(survey_url))
+            survey_key = survey_url.replace(bbox_TNM, '')
+            cached_survey = query_cache.lookup(survey_key, query_bbox)
+            if cached_survey is not None:
+                metrics.count('query_cache_hits')
+                items = cached_survey['items']
+            else:
+                items = [item for total, page in query_TNM(survey_url) for item in page]
+                query_cache.store(survey_key, query_bbox, {'items': items})
+            surveyed_items[dataset] = items
+            items = [item for item in items if any(
+                     area.intersects(item.get('boundingBox')) for area in footprints)]
+            boxes = [item['boundingBox'] for item in items if item.get('boundingBox')]
+            dataset_survey.append({
+                'dataset': dataset,
+                'resolution': dataset_resolution(dataset),
+                'tile_count': len(items),
+                'bytes': sum(int(item['sizeInBytes']) for item in items),
+                'coverage': min(area.coverage(boxes) for area in footprints),
+                })
+        # the finest dataset is used for a region finer than all datasets
+        adequate = [survey for survey in dataset_survey
+                    if survey['resolution'] <= region_resolution * 1.001]
+        adequate = adequate or dataset_survey[-1:]
+        complete = [survey for survey in adequate if survey['coverage'] == 1.]
+        if complete:
+            selected = complete[0]
+        else:
+            # a coarser dataset is preferred to gaps in the output
+            complete = [survey for survey in dataset_survey if survey['coverage'] == 1.]
+            if complete:
+                selected = complete[-1]
+            else:
+                selected = max(adequate + dataset_survey,
+                               key=lambda survey: survey['coverage'])
+            gscript.warning("No NED dataset meeting the region resolution has "
+                            "tiles for the whole region, {0} is used.".format(
+                                selected['dataset']))
+        selected['selected'] = True
+        gui_dataset = selected['dataset']
+        product_tag = product + " " + gui_dataset
+        ned_data_abbrv = ned_abbreviations[gui_dataset]
+        product_resolution = dataset_resolution(gui_dataset)
+        gscript.verbose("NED dataset {0} selected for region resolution {1}".format(
+                        gui_dataset, region_resolution))
+
+    # tiles already imported into the output are kept when updating it
+    update_record = None
+    if gui_u_flag:
+        if gscript.find_file(gui_output_layer, element='cell', mapset='.')['name']:
+            update_record = read_import_record(gui_output_layer)
+            if update_record is None:
+                gscript.fatal("Raster map <{0}> was not created by r.in.usgs "
+                              "and cannot be updated.".format(gui_output_layer))
+            if (update_record['dataset'] != product_tag or
+                    update_record['resolution'] != product_resolution):
+                gscript.fatal("Raster map <{0}> was created from {1} and cannot be "
+                              "updated with {2}.".format(gui_output_layer,
+                                                         update_record['dataset'],
+                                                         product_tag))
+        else:
+            gscript.verbose("Raster map <{0}> not found, all tiles are imported".format(
+                            gui_output_layer))
+    if update_record:
+        update_extent = update_record['extent']
+        region_grown = (gregion['n'] > update_extent['n'] or
+                        gregion['s'] < update_extent['s'] or
+                        gregion['e'] > update_extent['e'] or
+                        gregion['w'] < update_extent['w'])
+        # a tile cut off by the previous extent is imported again
+        update_footprint = Footprint(transform_coordinates(
+            region_boundary(update_extent), product_proj4))
+        update_urls = set(update_record['tiles'])
+        import_output = "{0}_update_{1}".format(gui_output_layer, os.getpid())
+    else:
+        import_output = gui_output_layer
+    TNM_API_URL = TNM_query_url(product_tag)
     gscript.verbose("TNM API Query URL:\t{0}".format(TNM_API_URL))
+    query_key = TNM_API_URL.replace(bbox_TNM, '')
+    cached_JSON = query_cache.lookup(query_key, query_bbox)
+    listing = None
+    if cached_JSON is not None:
+        gscript.verbose("TNM API response reused from query cache")
+        metrics.count('query_cache_hits')
+        TNM_pages = [(cached_JSON['total'], cached_JSON['items'])]
+    elif gui_dataset in surveyed_items:
+        TNM_pages = [(len(surveyed_items[gui_dataset]), surveyed_items[gui_dataset])]
+    else:
+        # Query TNM API one page at a time
+        TNM_pages = query_TNM(TNM_API_URL)
+        # pages are stored as they arrive
+        listing = query_cache.open_listing(query_key, query_bbox)
+
+    size_diff_tolerance = 5
+    # Index of downloaded files shared with other r.in.usgs processes
+    tile_cache = TileCache(cache_dir, max_bytes=cache_size,
+                           tolerance=size_diff_tolerance)
+    # Reprojected tiles are reused from the cache mapset when they are
+    # patched one by one
+    if gui_import_cache and not gui_m_flag and not batch_outputs and not link_tiles:
+        try:
+            import_cache = ImportCache(gui_import_cache, max_bytes=import_cache_size)
+        except (IOError, OSError) as error:
+            gscript.fatal("Unable to create import cache mapset <{0}>: {1}".format(
+                          gui_import_cache, error))
+        # grid of the patched output, the tiles are imported aligned to it
+        if product_resolution:
+            import_grid = {'w': 0., 's': 0., 'nsres': product_resolution,
+                           'ewres': product_resolution}
+        else:
+            import_grid = gregion
+    else:
+        import_cache = None
+    # cache map name of each downloaded file
+    tile_import_names = {}
+    # linked tiles are extracted to a directory kept with the tile cache
+    if link_tiles:
+        extract_dir = os.path.join(cache_dir, 'tiles')
+        if not os.path.isdir(extract_dir):
+            os.makedirs(extract_dir)
+    else:
+        extract_dir = work_dir
+    # with a scratch budget, downloaded files in output_directory are
+    # removed once used and [archive, extracted] bytes are held per file
+    scratch_archives = bool(scratch_budget) and (os.path.realpath(cache_dir) ==
+                                                 os.path.realpath(work_dir))
+    scratch_costs = {}
+    deferred_tiles = []
+
+    def release_scratch(source, archive=True, extracted=True):
+        cost = scratch_costs.get(source)
+        if not cost:
+            return
+        nbytes = 0
+        if archive:
+            nbytes, cost[0] = nbytes + cost[0], 0
+        if extracted:
+            nbytes, cost[1] = nbytes + cost[1], 0
+        scratch_budget.release(nbytes)
+
+    def remove_archive(source):
+        if scratch_archives:
+            tile_cache.remove(os.path.basename(source))
+        release_scratch(source, extracted=False)
+
+    local_tile_path_list = []
+    patch_tiles = []
+    mosaic_tiles = []
+    # downloaded file of each extracted or located tile
+    tile_sources = {}
+    area_errors = []
+    # Remote tiles are read by GDAL through a local server which keeps
+    # the blocks read in the block cache
+    if gui_r_flag:
+        block_cache = BlockCache(os.path.join(cache_dir, 'blocks'))
+        block_proxy = BlockProxy(block_cache)
+        atexit.register(block_proxy.close)
+        # the archive directory is read by the module, GDAL should not
+        # list the server
+        os.environ['GDAL_DISABLE_READDIR_ON_OPEN'] = 'EMPTY_DIR'
+        os.environ['VSI_CACHE'] = 'TRUE'
+        no_proxy = os.environ.get('no_proxy')
+        os.environ['no_proxy'] = no_proxy + ',127.0.0.1' if no_proxy else '127.0.0.1'
+    else:
+        block_cache = None
+    import_env = os.environ.copy()
+    # the region tiles were queried for, also when it is a temporary
+    # region of the caller, which region_env() without options ignores
+    import_env['GRASS_REGION'] = gscript.region_env(
+        n=gregion['n'], s=gregion['s'], e=gregion['e'], w=gregion['w'],
+        nsres=gregion['nsres'], ewres=gregion['ewres'])
+
+    # Processing stages, each tile is extracted and imported as soon
+    # as it is available while other tiles are still downloaded
+    def extract_tile(item):
+        order, z = item
+        if z.startswith('/vsi'):
+            # remote tile
+            return item
+        # Extract tiles from ZIP archives, a tile extracted by an
+        # earlier run is reused when it matches the archive
+        started = time.time()
+        extracted_tile = None
+        extracted = False
+        try:
+            with zipfile.ZipFile(z, "r") as read_zip:
+                members = [info for info in read_zip.infolist()
+                           if info.filename.endswith(product_extension)]
+                if members:
+                    extracted_tile = os.path.join(extract_dir, members[-1].filename)
+                    gscript.verbose("Extracting {0}...".format(members[-1].filename))
+                    extracted_tile, extracted = extract_member(read_zip, members[-1],
+                                                               extract_dir)
+        except (zipfile.BadZipfile, zlib.error, IOError, OSError):
+            pass
+        if extracted_tile is None or not os.path.exists(extracted_tile):
+            if extracted_tile:
+                cleanup_list.append(extracted_tile)
+            raise ProcessingError("Unable to locate or extract IMG file from ZIP archive.")
+        # extracted tiles are kept for reuse with the 'k' flag
+        if not link_tiles and not gui_k_flag:
+            cleanup_list.append(extracted_tile)
+        tile_sources[extracted_tile] = z
+        if extracted:
+            metrics.add('extract', started, os.path.getsize(extracted_tile))
+        else:
+            metrics.count('extract_reused')
+        if scratch_budget:
+            remove_archive(z)
+        return order, extracted_tile
+
+    def locate_tile(item):
+        order, z = item
+        if z.startswith('/vsi'):
+            # remote tile
+            return item
+        # GDAL reads the tile directly from the archive
+        try:
+            with zipfile.ZipFile(z, "r") as read_zip:
+                members = [f for f in read_zip.namelist()
+                           if f.endswith(product_extension)]
+        except (zipfile.BadZipfile, IOError):
+            members = []
+        if not members:
+            raise ProcessingError("Unable to locate IMG file in ZIP archive.")
+        virtual_tile = "/vsizip/{0}/{1}".format(z, members[-1])
+        tile_sources[virtual_tile] = z
+        return order, virtual_tile
+
+    def import_tile(item):
+        order, t = item
+        local_tile_path_list.append(t)
+        # create variables for use in GRASS GIS import process
+        LT_file_name = os.path.basename(t)
+        LT_layer_name = os.path.splitext(LT_file_name)[0]
+        is_virtual = t.startswith('/vsi')
+        in_info = ("Importing and reprojecting {0}...").format(LT_file_name)
+        gscript.info(in_info)
+        cache_item = tile_import_names.get(tile_sources.get(t, t))
+        # import to GRASS GIS, parallel imports use their own region
+        # through the environment and do not modify the WIND file
+        try:
+            with metrics.stage('import', 0 if is_virtual else os.path.getsize(t)):
+                if cache_item:
+                    # the whole tile is imported into the cache mapset
+                    cache_name, tile_region = cache_item
+                    LT_layer_name = None
+                    if import_cache.held(cache_name):
+                        # imported by this process already
+                        LT_layer_name = import_cache.lookup(cache_name)
+                    # the map is imported again if another process evicts
+                    # it before it is held
+                    while not LT_layer_name:
+                        with import_cache.lock(cache_name):
+                            # another process may have imported it meanwhile
+                            LT_layer_name = import_cache.lookup(cache_name)
+                            if not LT_layer_name:
+                                cache_env = import_cache.env.copy()
+                                cache_env['GRASS_REGION'] = gscript.region_env(**tile_region)
+                                gscript.run_command('r.import', input=t, output=cache_name,
+                                                    resolution='value', resolution_value=product_resolution,
+                                                    extent="region", resample=gui_resampling_method,
+                                                    env=cache_env)
+                                LT_layer_name = import_cache.add(cache_name)
+                        if not import_cache.hold(cache_name):
+                            LT_layer_name = None
+                else:
+                    gscript.run_command('r.import', input=t, output=LT_layer_name,
+                                        resolution='value', resolution_value=product_resolution,
+                                        extent="region", resample=gui_resampling_method,
+                                        env=import_env)
+            if not gui_k_flag and not is_virtual:
+                cleanup_list.append(t)
+        except CalledModuleError:
+            in_error = ("Unable to import '{0}'").format(LT_file_name)
+            raise ProcessingError(in_error)
+        patch_tiles.append((order, LT_layer_name))
+        if scratch_budget:
+            # files of the tile are no longer needed
+            source = tile_sources.get(t, t)
+            if not is_virtual and t != source:
+                gscript.try_remove(t)
+            remove_archive(source)
+            release_scratch(source)
+
+    def link_tile(item):
+        order, t = item
+        local_tile_path_list.append(t)
+        # named apart from the tiles of a normal import, which are
+        # removed after patching
+        LT_layer_name = "{0}_link_{1}".format(gui_output_layer,
+                                              os.path.splitext(os.path.basename(t))[0])
+        gscript.info("Linking {0}...".format(os.path.basename(t)))
+        # the coordinate systems were compared already, GDAL may
+        # describe the same one differently
+        try:
+            with metrics.stage('link'):
+                gscript.run_command('r.external', input=t, output=LT_layer_name,
+                                    flags='o', overwrite=True)
+        except CalledModuleError:
+            raise ProcessingError("Unable to link '{0}'".format(os.path.basename(t)))
+        patch_tiles.append((order, LT_layer_name))
+
+    def collect_tile(item):
+        order, t = item
+        local_tile_path_list.append(t)
+        mosaic_tiles.append((order, t))
+        if not gui_k_flag and not t.startswith('/vsi'):
+            cleanup_list.append(t)
+
+    def import_area(item):
+        name, region, tiles = item
+        area_output = "{0}_{1}".format(gui_output_layer, name)
+        started = time.time()
+        # each area is imported and patched in its own region
+        # passed through the environment
+        if product_resolution:
+            region_options = {'res': product_resolution, 'flags': 'a'}
+        else:
+            region_options = {'nsres': region['nsres'], 'ewres': region['ewres']}
+        area_env = os.environ.copy()
+        area_env['GRASS_REGION'] = gscript.region_env(n=region['n'], s=region['s'],
+                                                      e=region['e'], w=region['w'],
+                                                      **region_options)
+        tile_names = []
+        try:
+            if gui_m_flag:
+                vrt_path = os.path.join(work_dir, area_output + '.vrt')
+                cleanup_list.append(vrt_path)
+                build_vrt(vrt_path, tiles)
+                gscript.run_command('r.import', input=vrt_path, output=area_output,
+                                    resolution='value', resolution_value=product_resolution,
+                                    extent="region", resample=gui_resampling_method,
+                                    env=area_env)
+            else:
+                for i, t in enumerate(tiles):
+                    tile_name = "{0}_tile{1}".format(area_output, i)
+                    gscript.run_command('r.import', input=t, output=tile_name,
+                                        resolution='value', resolution_value=product_resolution,
+                                        extent="region", resample=gui_resampling_method,
+                                        env=area_env)
+                    tile_names.append(tile_name)
+                if len(tile_names) > 1:
+                    gscript.run_command('r.patch', input=tile_names,
+                                        output=area_output, env=area_env)
+                    if not gui_k_flag:
+                        gscript.run_command('g.remove', type='raster',
+                                            name=tile_names, flags='f')
+                else:
+                    gscript.run_command('g.rename', raster=(tile_names[0], area_output))
+            if gui_product == 'ned':
+                gscript.run_command('r.colors', map=area_output, color='elevation')
+            if overview_factors:
+                build_overviews(area_output, overview_factors, overview_method,
+                                env=area_env)
+        except (CalledModuleError, ProcessingError) as error:
+            # other areas are still imported
+            if tile_names:
+                gscript.run_command('g.remove', type='raster',
+                                    name=tile_names, flags='f')
+            area_errors.append("Unable to import area '{0}': {1}".format(name, error))
+            return
+        metrics.add('area', started)
+        gscript.info("Raster map '{0}' created".format(area_output))
+
+    def import_areas(regions, tile_areas):
+        # tiles of each area in the order of download and then of
+        # existing tiles
+        area_tiles = [[] for region in regions]
+        for order, t in sorted(mosaic_tiles):
+            for i in tile_areas[tile_sources.get(t, t)]:
+                area_tiles[i].append(t)
+        # areas failing outside of import_area() stop the pipeline, they
+        # and the areas not yet imported are discarded
+        discarded_areas = []
+        area_pipeline = Pipeline([(import_area, gui_nprocs)],
+                                 discard=lambda item: discarded_areas.append(item[0]))
+        area_count = 0
+        for (name, region), tiles in zip(regions, area_tiles):
+            if tiles:
+                area_pipeline.put((name, region, tiles))
+                area_count += 1
+            else:
+                gscript.warning("No USGS tiles cover area '{0}', skipped".format(name))
+        pipeline_errors = area_pipeline.join()
+        for error in area_errors + [str(error) for error in pipeline_errors]:
+            gscript.warning(error)
+        if discarded_areas:
+            gscript.warning("Area(s) not imported after an error: {0}".format(
+                            ", ".join(discarded_areas)))
+        if gui_k_flag:
+            gscript.info(("<k> flag selected: Source tiles remain in '{0}'").format(work_dir))
+        failed_count = len(area_errors) + len(discarded_areas)
+        if failed_count:
+            gscript.fatal("{0} of {1} area(s) failed to import.".format(
+                          failed_count, area_count))
+        gscript.info("\n{0} area(s) from {1} tile(s) succesfully imported.".format(
+                     area_count, len(local_tile_path_list)))
+
+    def downloaded(index, local_file_path, error):
+        if error is None:
+            pipeline.put(((0, index), local_file_path))
+        elif scratch_budget:
+            release_scratch(local_file_path)
+
+    def discarded(item):
+        order, t = item
+        # no further tiles are downloaded once processing stopped
+        if downloader:
+            downloader.stop()
+        source = tile_sources.get(t, t)
+        # tiles extracted for this run are not imported anymore
+        if t != source and not t.startswith('/vsi') and not link_tiles and not gui_k_flag:
+            gscript.try_remove(t)
+        if scratch_budget:
+            remove_archive(source)
+            release_scratch(source)
+
+    # Downloads and processing start as soon as tiles are listed,
+    # except with 'i' flag
+    if gui_i_flag:
+        downloader = None
+        pipeline = None
+    else:
+        if gui_m_flag or batch_outputs:
+            stages = [(collect_tile, 1)]
+        elif link_tiles:
+            stages = [(link_tile, gui_nprocs)]
+        else:
+            stages = [(import_tile, gui_nprocs)]
+        if product_is_zip and gui_z_flag:
+            stages.insert(0, (locate_tile, 1))
+        elif product_is_zip:
+            stages.insert(0, (extract_tile, gui_nprocs))
+        pipeline = Pipeline(stages, discard=discarded)
+        downloader = TileDownloader(max_connections=gui_max_connections,
+                                    retries=gui_retries, cache=tile_cache,
+                                    callback=downloaded)
 
-    # Query TNM API
-    try:
-        TNM_API_GET = urllib2.urlopen(TNM_API_URL, timeout=12)
-    except urllib2.URLError:
-        gscript.fatal("USGS TNM API query has timed out. Check network configuration. Please try again.")
-    except:
-        gscript.fatal("USGS TNM API query has timed out. Check network configuration. Please try again.")
-    
-    # Parse return JSON object from API query
-    try:
-        return_JSON = json.load(TNM_API_GET)
-        if return_JSON['errors']:
-            TNM_API_error = return_JSON['errors']
-            api_error_msg = "TNM API Error - {0}".format(str(TNM_API_error))
-            gscript.fatal(api_error_msg)
-
-    except:
-        gscript.fatal("Unable to load USGS JSON object.")
-    
     # Functions down_list() and exist_list() used to determine 
     # existing files and those that need to be downloaded.
     def down_list():
@@ -359,6 +2982,15 @@ def main():
         if f['datasets'][0] not in dataset_name:
             if len(dataset_name) <= 1:
                 dataset_name.append(str(f['datasets'][0]))
+        if downloader and scratch_budget:
+            # started once the free space is checked
+            deferred_tiles.append((lambda args=(TNM_file_URL, local_file_path,
+                                                TNM_file_size, TNM_file_modified):
+                                   downloader.submit(*args),
+                                   local_file_path, plan_tile))
+        elif downloader:
+            downloader.submit(TNM_file_URL, local_file_path, TNM_file_size,
+                              TNM_file_modified)
 
     def exist_list():
         exist_TNM_titles.append(TNM_file_title)
@@ -368,81 +3000,173 @@ def main():
             extract_zip_list.append(local_zip_path)
         else:
             exist_tile_list.append(local_tile_path)
+        if pipeline and scratch_budget:
+            deferred_tiles.append((lambda item=((1, len(exist_dwnld_url)), local_file_path):
+                                   pipeline.put(item),
+                                   local_file_path, plan_tile))
+        elif pipeline:
+            pipeline.put(((1, len(exist_dwnld_url)), local_file_path))
 
     # Assign needed parameters from returned JSON
-    tile_API_count = int(return_JSON['total'])
+    tile_API_count = 0
     tiles_needed_count = 0
-    size_diff_tolerance = 5
     exist_dwnld_size = 0
-    if tile_API_count > 0:
-        dwnld_size = []
-        dwnld_url = []
-        dataset_name = []
-        TNM_file_titles = []
-        exist_dwnld_url = []
-        exist_TNM_titles = []
-        exist_zip_list = []
-        exist_tile_list = []
-        extract_zip_list = []
+    dwnld_size = []
+    dwnld_url = []
+    dataset_name = []
+    TNM_file_titles = []
+    exist_dwnld_url = []
+    exist_TNM_titles = []
+    exist_zip_list = []
+    exist_tile_list = []
+    extract_zip_list = []
+    resume_list = []
+    skipped_titles = []
+    reused_titles = []
+    remote_titles = []
+    import_cache_hits = 0
+    listed_count = 0
+    plan_tiles = []
+    # areas of interest covered by each downloaded file
+    tile_areas = {}
+    for page, (tile_API_count, TNM_items) in enumerate(TNM_pages):
+        if listing is not None:
+            query_cache.add_page(listing, page, TNM_items)
+            listed_count += len(TNM_items)
         # for each file returned, assign variables to needed parameters
-        for f in return_JSON['items']:
+        for f in TNM_items:
             TNM_file_title = f['title']
+            # NLCD API query returns subsets that cannot be filtered before
+            # results are returned. gui_subset is used to filter results.
+            if nlcd_epochs:
+                tile_epochs = [i for i, epoch in enumerate(nlcd_epochs)
+                               if epoch[1] in f.get('datasets', [epoch[1]]) and
+                               epoch[2] in TNM_file_title]
+                if not tile_epochs:
+                    continue
+            elif gui_subset and gui_subset not in TNM_file_title:
+                continue
+            # the API selects tiles by bbox, skip those outside the region
+            # or outside all areas of interest
+            covered_areas = [i for i, area in enumerate(footprints)
+                             if area.intersects(f.get('boundingBox'))]
+            if not covered_areas:
+                skipped_titles.append(TNM_file_title)
+                continue
+            if nlcd_epochs:
+                covered_areas = [i * len(areas) + j for i in tile_epochs
+                                 for j in covered_areas]
             TNM_file_URL = str(f['downloadURL'])
+            if update_record and TNM_file_URL in update_urls and (
+                    not region_grown or
+                    update_footprint.covers(f.get('boundingBox'))):
+                reused_titles.append(TNM_file_title)
+                continue
             TNM_file_size = int(f['sizeInBytes'])
+            TNM_file_modified = f.get('lastUpdated')
             TNM_file_name = TNM_file_URL.split(product_url_split)[-1]
             if gui_product == 'ned':
-                local_file_path = os.path.join(work_dir, ned_data_abbrv + TNM_file_name)
-                local_zip_path = os.path.join(work_dir, ned_data_abbrv + TNM_file_name)
-                local_tile_path = os.path.join(work_dir, ned_data_abbrv + TNM_file_name)
+                local_file_name = ned_data_abbrv + TNM_file_name
             else:
-                local_file_path = os.path.join(work_dir, TNM_file_name)
-                local_zip_path = os.path.join(work_dir, TNM_file_name)
-                local_tile_path = os.path.join(work_dir, TNM_file_name)
-            file_exists = os.path.exists(local_file_path)
-            file_complete = None
-            # if file exists, but is incomplete, remove file and redownload
-            if file_exists:
-                existing_local_file_size = os.path.getsize(local_file_path)
-                # if local file is incomplete
-                if abs(existing_local_file_size - TNM_file_size) > size_diff_tolerance:
-                    # add file to cleanup list
-                    cleanup_list.append(local_file_path)
-                    # NLCD API query returns subsets that cannot be filtered before
-                    # results are returned. gui_subset is used to filter results.
-                    if not gui_subset:
-                        tiles_needed_count += 1
-                        down_list()
-                    else:
-                        if gui_subset in TNM_file_title:
-                            tiles_needed_count += 1
-                            down_list()
-                        else:
-                            continue
-                else:
-                    if not gui_subset:
-                        tiles_needed_count += 1
-                        exist_list()
-                        exist_dwnld_size += TNM_file_size
-                    else:
-                        if gui_subset in TNM_file_title:
-                            tiles_needed_count += 1
-                            exist_list()
-                            exist_dwnld_size += TNM_file_size
-                        else:
-                            continue
+                local_file_name = TNM_file_name
+            local_file_path = tile_cache.path(local_file_name)
+            local_zip_path = local_file_path
+            local_tile_path = local_file_path
+            tiles_needed_count += 1
+            tile_areas[local_file_path] = covered_areas
+            plan_tile = {'title': TNM_file_title, 'url': TNM_file_URL,
+                         'bytes': TNM_file_size}
+            if batch_outputs:
+                plan_tile['areas'] = [batch_outputs[i][0] for i in covered_areas]
+            if import_cache and f.get('boundingBox'):
+                # tile extent in the location grown to the output grid
+                tile_box = f['boundingBox']
+                tile_points = transform_coordinates(
+                    region_boundary({'n': tile_box['maxY'], 's': tile_box['minY'],
+                                     'e': tile_box['maxX'], 'w': tile_box['minX']}),
+                    location_proj4(), proj_in=product_proj4)
+                tile_region = align_region(
+                    {'n': max(y for x, y in tile_points), 's': min(y for x, y in tile_points),
+                     'e': max(x for x, y in tile_points), 'w': min(x for x, y in tile_points)},
+                    import_grid)
+                cache_name = ImportCache.name({
+                    'url': TNM_file_URL, 'last_modified': TNM_file_modified,
+                    'crs': location_proj4(), 'region': tile_region,
+                    'resolution': product_resolution,
+                    'resampling_method': gui_resampling_method})
+                tile_import_names[local_file_path] = cache_name, tile_region
+                cached_map = import_cache.lookup(cache_name)
+                # held until patched, checked again once held
+                if cached_map and import_cache.hold(cache_name):
+                    # reprojected tile is patched right away
+                    metrics.count('import_cache_hits')
+                    import_cache_hits += 1
+                    plan_tile['cache_status'] = 'imported'
+                    plan_tile['download_bytes'] = 0
+                    plan_tiles.append(plan_tile)
+                    local_tile_path_list.append(cached_map)
+                    patch_tiles.append(((2, import_cache_hits), cached_map))
+                    continue
+                metrics.count('import_cache_misses')
+            # cached files are held until used, checked again once held
+            if (tile_cache.lookup(TNM_file_URL, local_file_name, TNM_file_size,
+                                  TNM_file_modified) and
+                    tile_cache.hold(local_file_name)):
+                metrics.count('cache_hits')
+                plan_tile['cache_status'] = 'present'
+                plan_tile['download_bytes'] = 0
+                if (gui_plan or scratch_budget) and product_is_zip:
+                    plan_tile['extracted_bytes'] = extracted_size(local_file_path,
+                                                                  product_extension)
+                exist_list()
+                exist_dwnld_size += TNM_file_size
             else:
-                if not gui_subset:
-                    tiles_needed_count += 1
-                    down_list()
+                metrics.count('cache_misses')
+                remote_tile = None
+                if block_cache:
+                    remote_tile = remote_tile_path(block_cache, block_proxy, TNM_file_URL,
+                                                   TNM_file_modified, TNM_file_name,
+                                                   product_extension, product_is_zip)
+                    if remote_tile is None:
+                        gscript.verbose("Range requests not supported for {0}, "
+                                        "tile is downloaded".format(TNM_file_title))
+                if remote_tile:
+                    metrics.count('remote_tiles')
+                    plan_tile['cache_status'] = 'remote'
+                    plan_tile['download_bytes'] = 0
+                    plan_tiles.append(plan_tile)
+                    remote_titles.append(TNM_file_title)
+                    tile_sources[remote_tile] = local_file_path
+                    if pipeline:
+                        pipeline.put(((-1, len(remote_titles)), remote_tile))
+                    continue
+                # partial files are continued where a previous download
+                # stopped, other incomplete files are downloaded again
+                download_state = read_download_state(local_file_path)
+                if download_state and download_state.get('url') == TNM_file_URL:
+                    resume_list.append(local_file_path)
+                    plan_tile['cache_status'] = 'partial'
+                    plan_tile['download_bytes'] = max(
+                        0, TNM_file_size - os.path.getsize(local_file_path))
                 else:
-                    if gui_subset in TNM_file_title:
-                        tiles_needed_count += 1
-                        down_list()
-                        continue
-    
+                    plan_tile['cache_status'] = 'missing'
+                    plan_tile['download_bytes'] = TNM_file_size
+                down_list()
+            plan_tiles.append(plan_tile)
+        # make room in the tile cache for the queued downloads
+        if downloader:
+            evicted = tile_cache.evict(keep=set(dwnld_url + exist_dwnld_url),
+                                       reserve=downloader.pending_bytes)
+            if evicted:
+                gscript.verbose("{0} least recently used file(s) removed from tile cache".format(
+                                len(evicted)))
+
     # return fatal error if API query returns no results for GUI input
-    elif tile_API_count == 0:
+    if tile_API_count == 0:
         gscript.fatal("TNM API ERROR or Zero tiles available for given input parameters.")
+    if listing is not None:
+        query_cache.close_listing(listing, listed_count)
+    query_cache.close()
     
     # number of files to be downloaded 
     file_download_count = len(dwnld_url)
@@ -462,20 +3186,13 @@ def main():
     if exist_tile_list:
         exist_msg = "\n{0} of {1} files/archive(s) exist locally and will be used by module.".format(len(exist_tile_list), tiles_needed_count)
         gscript.message(exist_msg)
-    if cleanup_list:
-        cleanup_msg = "\n{0} existing incomplete file(s) detected and removed. Run module again.".format(len(cleanup_list))
-        gscript.fatal(cleanup_msg)
+    if resume_list:
+        resume_msg = "\n{0} existing incomplete file(s) detected, download will be resumed.".format(len(resume_list))
+        gscript.message(resume_msg)
 
     # formats JSON size from bites into needed units for combined file size
     if dwnld_size:
-        total_size = sum(dwnld_size)
-        len_total_size = len(str(total_size))
-        if 6 < len_total_size < 10:
-            total_size_float = total_size * 1e-6
-            total_size_str = str("{0:.2f}".format(total_size_float) + " MB")
-        if len_total_size >= 10:
-            total_size_float = total_size * 1e-9
-            total_size_str = str("{0:.2f}".format(total_size_float) + " GB")
+        total_size_str = format_size(sum(dwnld_size))
     else:
         total_size_str = '0'
     
@@ -490,7 +3207,7 @@ def main():
         data_info = "\n\nUSGS file(s) to download: NONE"
         if gui_product == 'nlcd':
             if tile_API_count != file_download_count:
-                if tiles_needed_count == 0:
+                if tiles_needed_count == 0 and not reused_titles:
                     nlcd_unavailable = "NLCD {0} data unavailable for input parameters".format(gui_subset)
                     gscript.fatal(nlcd_unavailable)
         
@@ -508,11 +3225,157 @@ def main():
                                                 count=file_download_count,
                                                 srs=product_srs,
                                                 tile=TNM_file_titles_info)
-    print data_info
+    if dataset_survey:
+        survey_lines = ["NED dataset selection for region resolution {0}:".format(
+                        region_resolution)]
+        for survey in dataset_survey:
+            survey_lines.append("{0}:\t{1} tile(s), {2}, {3:.0f}% coverage{4}".format(
+                                survey['dataset'], survey['tile_count'],
+                                format_size(survey['bytes']), survey['coverage'] * 100,
+                                " (selected)" if survey.get('selected') else ""))
+        # savings against the finest dataset with tiles for the areas
+        finest = [survey for survey in dataset_survey if survey['tile_count']][-1:]
+        if finest and finest[0]['bytes'] > selected['bytes']:
+            survey_lines.append("Bytes saved compared to {0}:\t{1}".format(
+                                finest[0]['dataset'],
+                                format_size(finest[0]['bytes'] - selected['bytes'])))
+        survey_lines.append("-------------------------")
+        data_info += "\n" + "\n".join(survey_lines)
+    if skipped_titles:
+        skipped_info = (
+                        "USGS tile(s) outside of region skipped:\t{count}",
+                        "{tile}",
+                        "-------------------------",
+                        )
+        data_info += "\n" + '\n'.join(skipped_info).format(count=len(skipped_titles),
+                                                            tile="\n".join(skipped_titles))
+    if remote_titles:
+        remote_info = (
+                       "USGS tile(s) read remotely:\t{count}",
+                       "{tile}",
+                       "-------------------------",
+                       )
+        data_info += "\n" + '\n'.join(remote_info).format(count=len(remote_titles),
+                                                           tile="\n".join(remote_titles))
+    if reused_titles:
+        reused_info = (
+                       "USGS tile(s) already in <{output}>:\t{count}",
+                       "{tile}",
+                       "-------------------------",
+                       )
+        data_info += "\n" + '\n'.join(reused_info).format(output=gui_output_layer,
+                                                           count=len(reused_titles),
+                                                           tile="\n".join(reused_titles))
+    if gui_plan == '-':
+        # standard output is reserved for the plan
+        gscript.message(data_info)
+    else:
+        print data_info
+
+    # extracted size of tiles not yet in the cache is estimated
+    # from the compression ratio of cached tiles
+    known = [t for t in plan_tiles if t.get('extracted_bytes')]
+    if known:
+        ratio = float(sum(t['extracted_bytes'] for t in known)) / sum(t['bytes'] for t in known)
+    else:
+        ratio = EXTRACTED_SIZE_RATIO
+
+    def extracted_bytes(plan_tile):
+        if not product_is_zip or gui_z_flag:
+            return 0
+        return plan_tile.get('extracted_bytes') or int(plan_tile['bytes'] * ratio)
+
+    if gui_plan:
+        # estimate output size from the region at product resolution
+        if product_resolution:
+            plan_rows = int(math.ceil((gregion['n'] - gregion['s']) / product_resolution))
+            plan_cols = int(math.ceil((gregion['e'] - gregion['w']) / product_resolution))
+        else:
+            plan_rows, plan_cols = gregion['rows'], gregion['cols']
+        scratch_bytes = sum(extracted_bytes(t) for t in plan_tiles)
+        download_bytes = sum(t['download_bytes'] for t in plan_tiles)
+        throughput = tile_cache.throughput()
+        # stages run in parallel with nprocs workers, tiles read remotely
+        # or found in the import cache are neither extracted nor imported
+        processed = [t for t in plan_tiles
+                     if t['cache_status'] not in ('remote', 'imported')]
+        stage_units = {
+            'extract': (sum(extracted_bytes(t) for t in processed), gui_nprocs),
+            'import': (len([t for t in plan_tiles if t['cache_status'] != 'imported']),
+                       1 if gui_m_flag else gui_nprocs),
+            'patch': (plan_rows * plan_cols, 1),
+            }
+        stage_seconds = {'download': download_bytes / throughput if throughput else None}
+        for stage, (units, workers) in stage_units.items():
+            rate = tile_cache.stage_rate(stage)
+            stage_seconds[stage] = units * rate / workers if rate is not None else None
+        if batch_outputs or link_tiles:
+            # areas are imported and linked tiles are patched differently
+            stage_seconds['import'] = stage_seconds['patch'] = None
+        # tiles are extracted and imported while others are downloaded
+        estimates = [v for v in stage_seconds.values() if v is not None]
+        if estimates:
+            estimated_seconds = (max(stage_seconds['download'] or 0,
+                                     (stage_seconds['extract'] or 0) +
+                                     (stage_seconds['import'] or 0)) +
+                                 (stage_seconds['patch'] or 0))
+        else:
+            estimated_seconds = None
+        plan = {
+            'product': gui_product,
+            'dataset': product_tag,
+            'output_name': gui_output_layer,
+            'tile_count': len(plan_tiles),
+            'area_count': len(batch_outputs) if batch_outputs else None,
+            'dataset_selection': dataset_survey,
+            'tiles': plan_tiles,
+            'skipped_tiles': skipped_titles,
+            'reused_tiles': reused_titles,
+            'download_bytes': download_bytes,
+            'scratch_bytes': scratch_bytes,
+            'output': {'resolution': product_resolution,
+                       'rows': plan_rows,
+                       'cols': plan_cols,
+                       'cells': plan_rows * plan_cols,
+                       # imported NED and NLCD cells take 4 bytes uncompressed
+                       'bytes': plan_rows * plan_cols * 4},
+            'throughput_bytes_per_second': throughput,
+            'estimated_download_seconds': stage_seconds['download'],
+            'estimated_stage_seconds': stage_seconds,
+            'estimated_seconds': estimated_seconds,
+            }
+        if gui_plan == '-':
+            print json.dumps(plan, indent=2)
+        else:
+            with open(gui_plan, 'w') as plan_file:
+                json.dump(plan, plan_file, indent=2)
     
     if gui_i_flag:
         gscript.info("To download USGS data, remove <i> flag, and rerun r.in.usgs.")
         sys.exit()
+    if update_record and tiles_needed_count == 0:
+        gscript.info("Raster map <{0}> is up to date, no new tiles to import.".format(
+                     gui_output_layer))
+        return
+
+    if scratch_budget:
+        # archives downloaded to output_directory and extracted tiles
+        # are held until the tile is imported
+        for job, local_file_path, plan_tile in deferred_tiles:
+            archive_bytes = plan_tile['download_bytes'] if scratch_archives else 0
+            scratch_costs[local_file_path] = [archive_bytes, extracted_bytes(plan_tile)]
+        costs = [sum(cost) for cost in scratch_costs.values()] or [0]
+        needed = min(sum(costs), max(scratch_budget.max_bytes, max(costs)))
+        available = free_space(work_dir)
+        if available is not None and available < needed:
+            gscript.fatal("Not enough free space in '{0}': {1:.1f} MB needed, "
+                          "{2:.1f} MB available.".format(work_dir, needed / 1e6,
+                                                         available / 1e6))
+        for job, local_file_path, plan_tile in deferred_tiles:
+            if pipeline.aborted:
+                break
+            scratch_budget.acquire(sum(scratch_costs[local_file_path]))
+            job()
     
     # USGS data download process
     if file_download_count <= 0:
@@ -520,138 +3383,206 @@ def main():
     else:
         gscript.message("Downloading USGS Data...")
 
-    TNM_count = len(dwnld_url)
-    download_count = 0
-    local_tile_path_list = []
-    local_zip_path_list = []
-    patch_names = []
-
-    # Download files
-    for url in dwnld_url:
-        # create file name by splitting name from returned url
-        # add file name to local download directory
-        if gui_product == 'ned':
-            file_name = ned_data_abbrv + url.split(product_url_split)[-1]
-            local_file_path = os.path.join(work_dir, file_name)
-        else:
-            file_name = url.split(product_url_split)[-1]
-            local_file_path = os.path.join(work_dir, file_name)
-        try:
-            # download files in chunks rather than write complete files to memory
-            dwnld_req = urllib2.urlopen(url, timeout=12)
-            download_bytes = int(dwnld_req.info()['Content-Length'])
-            CHUNK = 16 * 1024
-            with open(local_file_path, "wb+") as local_file:
-                count = 0
-                steps = int(download_bytes / CHUNK) + 1
-                while True:
-                    chunk = dwnld_req.read(CHUNK)
-                    gscript.percent(count, steps, 10)
-                    count += 1
-                    if not chunk:
-                        break
-                    local_file.write(chunk)
-            local_file.close()
-            download_count += 1
-            # determine if file is a zip archive or another format
-            if product_is_zip:
-                local_zip_path_list.append(local_file_path)
-            else:
-                local_tile_path_list.append(local_file_path)
-            file_complete = "Download {0} of {1}: COMPLETE".format(
-                    download_count, TNM_count)
-            gscript.info(file_complete)
-        except urllib2.URLError:
-            gscript.fatal("USGS download request has timed out. Network or formatting error.")
-        except StandardError:
-            cleanup_list.append(local_file_path)
-            if download_count:
-                file_failed = "Download {0} of {1}: FAILED".format(
-                            download_count, TNM_count)
-                gscript.fatal(file_failed)
-
-    # sets already downloaded zip files or tiles to be extracted or imported
-    if exist_zip_list:
-        for z in exist_zip_list:
-            local_zip_path_list.append(z)
-    if exist_tile_list:
-        for t in exist_tile_list:
-            local_tile_path_list.append(t)
-    if product_is_zip:
-        if file_download_count == 0:
-            pass
-        else:
-            gscript.message("Extracting data...")
-        # for each zip archive, extract needed file
-        for z in local_zip_path_list:
-            # Extract tiles from ZIP archives
-            try:
-                with zipfile.ZipFile(z, "r") as read_zip:
-                    for f in read_zip.namelist():
-                        if f.endswith(product_extension):
-                            extracted_tile = os.path.join(work_dir, str(f))
-                            if os.path.exists(extracted_tile):
-                                os.remove(extracted_tile)
-                                read_zip.extract(f, work_dir)
-                            else:
-                                read_zip.extract(f, work_dir)
-                if os.path.exists(extracted_tile):
-                    local_tile_path_list.append(extracted_tile)
-                    cleanup_list.append(extracted_tile)
-            except:
-                cleanup_list.append(extracted_tile)
-                gscript.fatal("Unable to locate or extract IMG file from ZIP archive.")
-    
-    # operations for extracted or complete files available locally
-    for t in local_tile_path_list:
-        # create variables for use in GRASS GIS import process
-        LT_file_name = os.path.basename(t)
-        LT_layer_name = os.path.splitext(LT_file_name)[0]
-        patch_names.append(LT_layer_name)
-        in_info = ("Importing and reprojecting {0}...").format(LT_file_name)
-        gscript.info(in_info)
-        # import to GRASS GIS
-        try:
-            gscript.run_command('r.import', input=t, output=LT_layer_name,
-                                resolution='value', resolution_value=product_resolution,
-                                extent="region", resample=product_interpolation)
-            if not gui_k_flag:
-                cleanup_list.append(t)
-        except CalledModuleError:
-            in_error = ("Unable to import '{0}'").format(LT_file_name)
-            gscript.fatal(in_error)
+    # Wait for downloads into the tile cache and for processing of tiles
+    download_results = downloader.finish()
+    tile_cache.record_throughput(*downloader.throughput())
+    processing_errors = pipeline.join()
+    if scratch_budget:
+        gscript.verbose("Peak scratch space used: {0:.1f} MB".format(
+                        scratch_budget.peak / 1e6))
+    if processing_errors:
+        # remove tiles imported before the failure
+        # maps of the import cache are kept
+        imported_names = [name for order, name in patch_tiles if '@' not in name]
+        if imported_names:
+            gscript.run_command('g.remove', type='raster',
+                                name=imported_names, flags='f')
+        for error in processing_errors[1:]:
+            gscript.warning(str(error))
+        gscript.fatal(str(processing_errors[0]))
+    for local_file_path, error in download_results:
+        if error is not None:
+            # partial file is kept so that the next run can resume it
+            file_failed = ("Download of {0} FAILED: {1}. "
+                           "Run module again to resume.").format(
+                          os.path.basename(local_file_path), error)
+            gscript.fatal(file_failed)
+
+    if batch_outputs:
+        import_areas(batch_outputs, tile_areas)
+        if nlcd_epochs:
+            # one space-time raster dataset for each subset, an epoch
+            # is valid for its year
+            subsets = dict((epoch[3], epoch[2]) for epoch in nlcd_epochs)
+            for subset in sorted(subsets):
+                if len(subsets) > 1:
+                    strds = "{0}_{1}".format(gui_output_layer, subset)
+                else:
+                    strds = gui_output_layer
+                epoch_maps = []
+                for i, epoch in enumerate(nlcd_epochs):
+                    if epoch[3] != subset:
+                        continue
+                    for name, region in batch_outputs[i * len(areas):(i + 1) * len(areas)]:
+                        epoch_map = "{0}_{1}".format(gui_output_layer, name)
+                        # areas without tiles are not imported
+                        if gscript.find_file(epoch_map, element='cell', mapset='.')['name']:
+                            epoch_maps.append((epoch_map, "{0}-01-01".format(epoch[4]),
+                                               "{0}-01-01".format(epoch[4] + 1)))
+                if not epoch_maps:
+                    continue
+                with metrics.stage('register'):
+                    register_epochs(strds, epoch_maps,
+                                    "{0} {1}".format(product, subsets[subset]))
+                gscript.info("Space time raster dataset <{0}> created with {1} map(s)".format(
+                             strds, len(epoch_maps)))
+        return
+
+    # patch in the order of download and then of existing tiles
+    patch_names = [name for order, name in sorted(patch_tiles)]
 
     # if control variables match and multiple files need to be patched, 
     # check product resolution, run r.patch
     
     # Check that downloaded files match expected count
     completed_tiles_count = len(local_tile_path_list)
-    if completed_tiles_count == tiles_needed_count:
+    if gui_m_flag and completed_tiles_count == tiles_needed_count:
+        # import all tiles as one mosaic, reprojected in a single pass
+        vrt_path = os.path.join(work_dir, gui_output_layer + '.vrt')
+        cleanup_list.append(vrt_path)
+        try:
+            with metrics.stage('vrt'):
+                build_vrt(vrt_path, [t for order, t in sorted(mosaic_tiles)])
+        except ProcessingError as error:
+            gscript.fatal(str(error))
+        gscript.info(("Importing and reprojecting mosaic of {0} tile(s)...").format(
+                     completed_tiles_count))
+        try:
+            with metrics.stage('import'):
+                gscript.run_command('r.import', input=vrt_path, output=import_output,
+                                    resolution='value', resolution_value=product_resolution,
+                                    extent="region", resample=gui_resampling_method,
+                                    env=import_env)
+        except CalledModuleError:
+            gscript.fatal(("Unable to import mosaic '{0}'").format(vrt_path))
+        temp_down_count = "\n{0} of {1} tile/s succesfully imported as mosaic.".format(completed_tiles_count,
+                          tiles_needed_count)
+        gscript.info(temp_down_count)
+    elif link_tiles and completed_tiles_count == tiles_needed_count:
+        # the linked tiles are kept, the output refers to them
+        if gscript.find_program('r.buildvrt', '--help'):
+            with metrics.stage('buildvrt'):
+                gscript.run_command('r.buildvrt', input=patch_names,
+                                    output=gui_output_layer)
+            gscript.info("\n{0} of {1} tile/s linked as virtual raster <{2}>.".format(
+                         completed_tiles_count, tiles_needed_count, gui_output_layer))
+        else:
+            gscript.warning("r.buildvrt not available, linked tiles are patched.")
+            try:
+                gscript.use_temp_region()
+                if product_resolution:
+                    gscript.run_command('g.region', res=product_resolution, flags='a')
+                with metrics.stage('patch'):
+                    gscript.run_command('r.patch', input=patch_names,
+                                        output=gui_output_layer)
+                gscript.del_temp_region()
+            except CalledModuleError:
+                gscript.fatal("Unable to patch tiles.")
+    elif completed_tiles_count == tiles_needed_count:
         if completed_tiles_count > 1:
             try:
                 gscript.use_temp_region()
                 # set the resolution
                 if product_resolution:
                     gscript.run_command('g.region', res=product_resolution, flags='a')
-                gscript.run_command('r.patch', input=patch_names,
-                                    output=gui_output_layer)
+                with metrics.stage('patch'):
+                    gscript.run_command('r.patch', input=patch_names,
+                                        output=import_output)
                 gscript.del_temp_region()
                 out_info = ("Patched composite layer '{0}' added").format(gui_output_layer)
                 gscript.verbose(out_info)
                 # Remove files if 'k' flag
-                if not gui_k_flag:
+                temp_names = [name for name in patch_names if '@' not in name]
+                if not gui_k_flag and temp_names:
                     gscript.run_command('g.remove', type='raster',
-                                        name=patch_names, flags='f')
+                                        name=temp_names, flags='f')
             except CalledModuleError:
                 gscript.fatal("Unable to patch tiles.")
         elif completed_tiles_count == 1:
-            gscript.run_command('g.rename', raster=(patch_names[0], gui_output_layer))
+            if '@' in patch_names[0]:
+                # tile from the import cache mapset
+                gscript.run_command('g.copy', raster=(patch_names[0], import_output))
+            else:
+                gscript.run_command('g.rename', raster=(patch_names[0], import_output))
         temp_down_count = "\n{0} of {1} tile/s succesfully imported and patched.".format(completed_tiles_count,
                           tiles_needed_count)
         gscript.info(temp_down_count)
     else:
         gscript.fatal("Error downloading files. Please retry.")
 
+    if update_record:
+        # patch the new tiles with the existing output in the union of
+        # both extents, new tiles take precedence
+        merged_output = "{0}_merged_{1}".format(gui_output_layer, os.getpid())
+        try:
+            gscript.use_temp_region()
+            gscript.run_command('g.region', n=max(gregion['n'], update_extent['n']),
+                                s=min(gregion['s'], update_extent['s']),
+                                e=max(gregion['e'], update_extent['e']),
+                                w=min(gregion['w'], update_extent['w']))
+            if product_resolution:
+                gscript.run_command('g.region', res=product_resolution, flags='a')
+            with metrics.stage('patch'):
+                gscript.run_command('r.patch', input=[import_output, gui_output_layer],
+                                    output=merged_output)
+            gscript.del_temp_region()
+            gscript.run_command('g.remove', type='raster', name=import_output,
+                                flags='f')
+            gscript.run_command('g.rename', raster=(merged_output, gui_output_layer),
+                                overwrite=True)
+        except CalledModuleError:
+            gscript.fatal("Unable to update <{0}> with new tiles.".format(
+                          gui_output_layer))
+        gscript.info("<{0}> updated with {1} new tile(s).".format(
+                     gui_output_layer, completed_tiles_count))
+
+    if import_cache:
+        evicted = import_cache.evict(keep=set(name.split('@')[0] for name in patch_names))
+        if evicted:
+            gscript.verbose("{0} least recently used tile(s) removed from import cache".format(
+                            len(evicted)))
+
+    # record tiles and extent of the output for later updates
+    output_info = gscript.raster_info(gui_output_layer)
+    # time per unit of work of this run for the estimates of later plans
+    stage_times = metrics.report()['stages']
+    if 'extract' in stage_times:
+        tile_cache.record_stage('extract', stage_times['extract']['bytes'],
+                                stage_times['extract']['seconds'])
+    if 'import' in stage_times:
+        tile_cache.record_stage('import', len(mosaic_tiles) if gui_m_flag
+                                else stage_times['import']['count'],
+                                stage_times['import']['seconds'])
+    if 'patch' in stage_times and not link_tiles:
+        tile_cache.record_stage('patch', output_info['rows'] * output_info['cols'],
+                                stage_times['patch']['seconds'])
+    import_record = {
+        'product': gui_product,
+        'dataset': product_tag,
+        'resolution': product_resolution,
+        'resampling_method': gui_resampling_method,
+        'extent': {'n': output_info['north'], 's': output_info['south'],
+                   'e': output_info['east'], 'w': output_info['west']},
+        'tiles': sorted(set(t['url'] for t in plan_tiles) |
+                        (update_urls if update_record else set())),
+        }
+    if link_tiles:
+        # the output refers to the linked maps
+        import_record['linked_maps'] = sorted(
+            set(patch_names) |
+            set(update_record.get('linked_maps', []) if update_record else []))
+    write_import_record(gui_output_layer, import_record)
+
     # Keep source files if 'k' flag active
     if gui_k_flag:
         src_msg = ("<k> flag selected: Source tiles remain in '{0}'").format(work_dir)
@@ -659,7 +3590,14 @@ def main():
 
     # set appropriate color table
     if gui_product == 'ned':
-        gscript.run_command('r.colors', map=gui_output_layer, color='elevation')
+        with metrics.stage('colors'):
+            gscript.run_command('r.colors', map=gui_output_layer, color='elevation')
+
+    if overview_factors:
+        with metrics.stage('overviews'):
+            overview_names = build_overviews(gui_output_layer, overview_factors,
+                                             overview_method)
+        gscript.info("Overviews created: {0}".format(", ".join(overview_names)))
 
 def cleanup():
     # Remove files in cleanup_list
@@ -0,0 +1,531 @@
+"""
+Name:      test_r_in_usgs
+Purpose:   Tests of download, cache and geometry helpers of r.in.usgs
+
+The tests do not access the USGS servers, downloads are served by a
+local HTTP server.
+"""
+
+import os
+import imp
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import time
+import httplib
+import zipfile
+import StringIO
+import urlparse
+import BaseHTTPServer
+
+from grass.exceptions import ScriptError
+from grass.gunittest.case import TestCase
+from grass.gunittest.main import test
+
+r_in_usgs = imp.load_source(
+    'r_in_usgs', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', 'r.in.usgs.py'))
+
+PAYLOAD = ''.join(chr(i % 251) for i in range(100000))
+
+
+class TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve PAYLOAD with Range support, closing early after truncate_at"""
+    truncate_at = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        start = 0
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            start = int(byte_range.split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, len(PAYLOAD) - 1, len(PAYLOAD)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(PAYLOAD) - start))
+        self.send_header('ETag', '"{0}"'.format(hashlib.md5(PAYLOAD).hexdigest()))
+        self.end_headers()
+        end = len(PAYLOAD)
+        if self.truncate_at is not None:
+            end = self.truncate_at
+        # HTTP/1.0 closes the connection after the body
+        self.wfile.write(PAYLOAD[start:end])
+
+
+class TestFetchTile(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), TileHandler)
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cls.url = 'http://127.0.0.1:{0}/tile.zip'.format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'tile.zip')
+        self.pool = r_in_usgs.ConnectionPool(timeout=5)
+        TileHandler.truncate_at = None
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.directory)
+
+    def fetch(self):
+        return r_in_usgs.fetch_tile(self.pool, self.url, self.path,
+                                    len(PAYLOAD), lambda nbytes: None)
+
+    def test_complete_download(self):
+        metadata = self.fetch()
+        with open(self.path, 'rb') as tile:
+            self.assertEqual(tile.read(), PAYLOAD)
+        self.assertEqual(metadata['md5'], hashlib.md5(PAYLOAD).hexdigest())
+        self.assertEqual(metadata['received'], len(PAYLOAD))
+        self.assertIsNone(r_in_usgs.read_download_state(self.path))
+
+    def test_truncated_download(self):
+        TileHandler.truncate_at = 40000
+        self.assertRaises(r_in_usgs.DownloadError, self.fetch)
+        self.assertEqual(os.path.getsize(self.path), 40000)
+        self.assertEqual(r_in_usgs.read_download_state(self.path)['url'], self.url)
+
+    def test_truncated_resumed_download(self):
+        """A short 206 response is not taken for a complete file"""
+        with open(self.path, 'wb') as partial:
+            partial.write(PAYLOAD[:50000])
+        r_in_usgs.write_download_state(self.path, {'url': self.url})
+        TileHandler.truncate_at = 75000
+        self.assertRaises(r_in_usgs.DownloadError, self.fetch)
+        self.assertEqual(os.path.getsize(self.path), 75000)
+        self.assertIsNotNone(r_in_usgs.read_download_state(self.path))
+        # the next attempt continues where the short response ended
+        TileHandler.truncate_at = None
+        metadata = self.fetch()
+        self.assertEqual(metadata['received'], len(PAYLOAD) - 75000)
+        with open(self.path, 'rb') as tile:
+            self.assertEqual(tile.read(), PAYLOAD)
+        self.assertIsNone(r_in_usgs.read_download_state(self.path))
+
+
+def zip_archive(member, data):
+    archive = StringIO.StringIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as tile_zip:
+        tile_zip.writestr(member, data)
+    return archive.getvalue()
+
+
+# NLCD archives are downloaded from a script, the file name is given in
+# the query only
+NLCD_NAME = 'NLCD2011_LC_N36W078.zip'
+NLCD_PATH = '/DownloadFile.php?TYPE=nlcd2011&FNAME=' + NLCD_NAME
+ARCHIVE = zip_archive('NLCD2011_LC_N36W078.tif', PAYLOAD[:5000])
+
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve ARCHIVE with byte range requests unless ranges is False"""
+    ranges = True
+    requests = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        RangeHandler.requests += 1
+        start, end = 0, len(ARCHIVE) - 1
+        byte_range = self.headers.get('Range')
+        if byte_range and self.ranges:
+            first, last = byte_range.split('=')[1].split('-')
+            start, end = int(first), min(int(last or end), end)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, end, len(ARCHIVE)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(ARCHIVE[start:end + 1])
+
+
+class TestRemoteRead(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), RangeHandler)
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cls.url = 'http://127.0.0.1:{0}{1}'.format(cls.server.server_port, NLCD_PATH)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = r_in_usgs.BlockCache(self.directory, block_size=1024, timeout=5)
+        self.proxy = r_in_usgs.BlockProxy(self.cache)
+        RangeHandler.ranges = True
+
+    def tearDown(self):
+        self.proxy.close()
+        shutil.rmtree(self.directory)
+
+    def test_blocks_cached(self):
+        self.assertEqual(self.cache.read(self.url, '2017', 1000, 2500),
+                         ARCHIVE[1000:3500])
+        requests = RangeHandler.requests
+        # later reads of the same blocks do not use the network
+        self.assertEqual(self.cache.read(self.url, '2017', 1500, 1000),
+                         ARCHIVE[1500:2500])
+        self.assertEqual(RangeHandler.requests, requests)
+        self.assertEqual(self.cache.read(self.url, '2017', len(ARCHIVE) - 10, 100),
+                         ARCHIVE[-10:])
+
+    def test_ranges_not_supported(self):
+        RangeHandler.ranges = False
+        self.assertIsNone(self.cache.size(self.url, '2017'))
+        self.assertIsNone(r_in_usgs.remote_tile_path(
+            self.cache, self.proxy, self.url, '2017', NLCD_NAME, '.tif', True))
+
+    def test_remote_tile_path(self):
+        path = r_in_usgs.remote_tile_path(self.cache, self.proxy, self.url, '2017',
+                                          NLCD_NAME, '.tif', True)
+        archive_url, member = path[len('/vsizip//vsicurl/'):].rsplit('/', 1)
+        self.assertTrue(path.startswith('/vsizip//vsicurl/http://127.0.0.1:'))
+        # GDAL finds the archive in the path by its extension
+        self.assertTrue(archive_url.endswith('.zip'))
+        self.assertEqual(member, 'NLCD2011_LC_N36W078.tif')
+        # the local server answers range requests from the block cache
+        connection = httplib.HTTPConnection(urlparse.urlsplit(archive_url).netloc, timeout=5)
+        connection.request('GET', urlparse.urlsplit(archive_url).path,
+                           headers={'Range': 'bytes=100-2099'})
+        response = connection.getresponse()
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.read(), ARCHIVE[100:2100])
+        connection.close()
+
+
+class TestScratchBudget(TestCase):
+
+    def test_blocks_until_released(self):
+        budget = r_in_usgs.ScratchBudget(100)
+        budget.acquire(60)
+        acquired = threading.Event()
+
+        def acquire():
+            budget.acquire(60)
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.2))
+        budget.release(60)
+        thread.join(5)
+        self.assertTrue(acquired.is_set())
+        self.assertEqual(budget.peak, 60)
+
+    def test_large_request_admitted_alone(self):
+        budget = r_in_usgs.ScratchBudget(100)
+        budget.acquire(250)
+        self.assertEqual(budget.used, 250)
+        budget.release(250)
+        self.assertEqual(budget.used, 0)
+
+
+class TestPipeline(TestCase):
+
+    def run_pipeline(self, function, items=20):
+        discarded = []
+        pipeline = r_in_usgs.Pipeline([(function, 2), (lambda item: None, 1)],
+                                      maxsize=1, discard=discarded.append)
+        # producers never block after a failure
+        for item in range(items):
+            pipeline.put(item)
+        return pipeline, pipeline.join(), discarded
+
+    def test_processing_error(self):
+        def function(item):
+            if item == 3:
+                raise r_in_usgs.ProcessingError("failed")
+            return item
+
+        pipeline, errors, discarded = self.run_pipeline(function)
+        self.assertTrue(pipeline.aborted)
+        self.assertEqual([str(error) for error in errors], ["failed"])
+        self.assertIn(3, discarded)
+
+    def test_other_exception(self):
+        def function(item):
+            if item == 0:
+                raise OSError(2, "No such file or directory")
+            return item
+
+        pipeline, errors, discarded = self.run_pipeline(function)
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], r_in_usgs.ProcessingError)
+        self.assertIn("OSError", str(errors[0]))
+        self.assertIn(0, discarded)
+
+    def test_system_exit(self):
+        def function(item):
+            if item == 5:
+                raise SystemExit(1)
+            return item
+
+        pipeline, errors, discarded = self.run_pipeline(function)
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], r_in_usgs.ProcessingError)
+
+    def test_all_items_processed(self):
+        pipeline, errors, discarded = self.run_pipeline(lambda item: item)
+        self.assertFalse(pipeline.aborted)
+        self.assertEqual(errors, [])
+        self.assertEqual(discarded, [])
+
+
+class TestBatchRegions(TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.txt')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def read(self, text):
+        with open(self.path, 'w') as regions_file:
+            regions_file.write(text)
+        return r_in_usgs.read_batch_regions(regions_file=self.path)
+
+    def test_regions_file(self):
+        regions = self.read("# name,north,south,east,west\n\n"
+                            "a, 36.4, 36.2, -78.9, -79.2\n"
+                            "b,36.6,36.3,-78.6,-79.4\n")
+        self.assertEqual(regions, [
+            ('a', {'n': 36.4, 's': 36.2, 'e': -78.9, 'w': -79.2}),
+            ('b', {'n': 36.6, 's': 36.3, 'e': -78.6, 'w': -79.4})])
+
+    def test_invalid_region(self):
+        self.assertRaises((SystemExit, ScriptError), self.read, "a,36.4,36.2,-78.9\n")
+        self.assertRaises((SystemExit, ScriptError), self.read, "a,north,36.2,-78.9,-79.2\n")
+
+    def test_duplicate_names(self):
+        self.assertRaises((SystemExit, ScriptError), self.read,
+                          "a,36.4,36.2,-78.9,-79.2\na,36.6,36.3,-78.6,-79.4\n")
+
+
+def bounding_box(west, south, east, north):
+    return {'minX': west, 'minY': south, 'maxX': east, 'maxY': north}
+
+
+class TestQueryCache(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.items = [{'title': 'a', 'boundingBox': bounding_box(0, 0, 1, 1)},
+                      {'title': 'b', 'boundingBox': bounding_box(5, 5, 6, 6)}]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_enclosed_bbox(self):
+        cache = r_in_usgs.QueryCache(self.directory, ttl=3600)
+        cache.store('key', [0, 0, 10, 10], {'total': 2, 'items': self.items})
+        response = cache.lookup('key', [0.2, 0.2, 0.8, 0.8])
+        self.assertEqual([item['title'] for item in response['items']], ['a'])
+        self.assertIsNone(cache.lookup('key', [-1, 0, 2, 2]))
+        self.assertIsNone(cache.lookup('other', [0.2, 0.2, 0.8, 0.8]))
+        cache.close()
+
+    def test_listing_stored_by_page(self):
+        cache = r_in_usgs.QueryCache(self.directory, ttl=3600)
+        listing = cache.open_listing('key', [0, 0, 10, 10])
+        cache.add_page(listing, 0, self.items[:1])
+        # an incomplete listing is not used
+        self.assertIsNone(cache.lookup('key', [0, 0, 10, 10]))
+        cache.add_page(listing, 1, self.items[1:])
+        cache.close_listing(listing, 2)
+        response = cache.lookup('key', [0, 0, 10, 10])
+        self.assertEqual([item['title'] for item in response['items']], ['a', 'b'])
+        cache.close()
+
+    def test_expired(self):
+        cache = r_in_usgs.QueryCache(self.directory, ttl=0.05)
+        cache.store('key', [0, 0, 10, 10], {'total': 2, 'items': self.items})
+        time.sleep(0.1)
+        self.assertIsNone(cache.lookup('key', [0.2, 0.2, 0.8, 0.8]))
+        cache.close()
+
+
+class TestTileCache(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, size):
+        with open(os.path.join(self.directory, name), 'wb') as tile:
+            tile.write('x' * size)
+
+    def test_lookup(self):
+        cache = r_in_usgs.TileCache(self.directory)
+        self.assertFalse(cache.lookup('http://a', 'a.zip', 100))
+        self.write('a.zip', 100)
+        cache.add('http://a', 'a.zip', '2017-01-01')
+        self.assertTrue(cache.lookup('http://a', 'a.zip', 100, '2017-01-01'))
+        # updated by USGS since the download
+        self.assertFalse(cache.lookup('http://a', 'a.zip', 100, '2018-01-01'))
+        # size differs from the TNM size by more than the tolerance
+        self.assertFalse(cache.lookup('http://a', 'a.zip', 200))
+        cache.close()
+
+    def test_partial_file_not_cached(self):
+        cache = r_in_usgs.TileCache(self.directory)
+        self.write('a.zip', 100)
+        r_in_usgs.write_download_state(os.path.join(self.directory, 'a.zip'),
+                                       {'url': 'http://a'})
+        self.assertFalse(cache.lookup('http://a', 'a.zip', 100))
+        cache.close()
+
+    def test_evict_least_recently_used(self):
+        cache = r_in_usgs.TileCache(self.directory, max_bytes=250)
+        for name in ('a', 'b', 'c'):
+            self.write(name + '.zip', 100)
+            cache.add('http://' + name, name + '.zip')
+            time.sleep(0.01)
+        self.assertTrue(cache.lookup('http://a', 'a.zip', 100))
+        removed = cache.evict()
+        self.assertEqual(removed, ['b.zip'])
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'b.zip')))
+        removed = cache.evict(keep=set(['http://c']), reserve=100)
+        self.assertEqual(removed, ['a.zip'])
+        cache.close()
+
+    def test_evict_skips_held_files(self):
+        cache = r_in_usgs.TileCache(self.directory, max_bytes=150)
+        for name in ('a', 'b'):
+            self.write(name + '.zip', 100)
+            cache.add('http://' + name, name + '.zip')
+            time.sleep(0.01)
+        # another process uses the least recently used file
+        other = r_in_usgs.TileCache(self.directory)
+        self.assertTrue(other.hold('a.zip'))
+        self.assertEqual(cache.evict(), ['b.zip'])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'a.zip')))
+        other.close()
+        self.assertEqual(cache.evict(reserve=100), ['a.zip'])
+        # a file evicted before it is held is reported missing
+        self.assertFalse(other.hold('a.zip'))
+        cache.close()
+
+    def test_lock_files_removed(self):
+        cache = r_in_usgs.TileCache(self.directory, max_bytes=150)
+        for name in ('a', 'b'):
+            self.write(name + '.zip', 100)
+            cache.add('http://' + name, name + '.zip')
+            self.assertTrue(cache.hold(name + '.zip'))
+            time.sleep(0.01)
+        locks = os.path.join(self.directory, 'locks')
+        self.assertEqual(sorted(os.listdir(locks)), ['a.zip.lock', 'b.zip.lock'])
+        cache.release('a.zip')
+        self.assertEqual(cache.evict(), ['a.zip'])
+        self.assertEqual(os.listdir(locks), ['b.zip.lock'])
+        self.assertTrue(cache.remove('b.zip'))
+        self.assertEqual(os.listdir(locks), [])
+        cache.close()
+
+    def test_remove_keeps_file_in_use(self):
+        cache = r_in_usgs.TileCache(self.directory)
+        self.write('a.zip', 100)
+        cache.add('http://a', 'a.zip')
+        other = r_in_usgs.TileCache(self.directory)
+        self.assertTrue(other.hold('a.zip'))
+        self.assertFalse(cache.remove('a.zip'))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'a.zip')))
+        other.close()
+        self.assertTrue(cache.remove('a.zip'))
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'a.zip')))
+        cache.close()
+
+    def test_lock_waiting_for_removed_lock_file(self):
+        cache = r_in_usgs.TileCache(self.directory)
+        other = r_in_usgs.TileCache(self.directory)
+        lock_file = cache.try_lock('a.zip')
+        locked, done = threading.Event(), threading.Event()
+
+        def write():
+            with other.lock('a.zip'):
+                locked.set()
+                done.wait(5)
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        self.assertFalse(locked.wait(0.2))
+        cache.remove_lock('a.zip', lock_file)
+        self.assertTrue(locked.wait(5))
+        # the writer locks the new lock file, not the removed one
+        self.assertIsNone(cache.try_lock('a.zip'))
+        done.set()
+        thread.join(5)
+        cache.close()
+        other.close()
+
+    def test_stage_rate(self):
+        cache = r_in_usgs.TileCache(self.directory)
+        self.assertIsNone(cache.stage_rate('import'))
+        cache.record_stage('import', 4, 10.)
+        cache.record_stage('import', 6, 20.)
+        # runs without work are not recorded
+        cache.record_stage('import', 0, 5.)
+        self.assertAlmostEqual(cache.stage_rate('import'), 3.)
+        self.assertAlmostEqual(cache.stage_rate('import', runs=1), 20. / 6)
+        self.assertIsNone(cache.stage_rate('patch'))
+        cache.close()
+
+
+class TestFootprint(TestCase):
+
+    def setUp(self):
+        # diamond with corners on the axes
+        self.footprint = r_in_usgs.Footprint([(0, -2), (2, 0), (0, 2), (-2, 0)])
+
+    def test_contains(self):
+        self.assertTrue(self.footprint.contains(0, 0))
+        self.assertTrue(self.footprint.contains(0.9, 0.9))
+        self.assertFalse(self.footprint.contains(1.5, 1.5))
+
+    def test_intersects(self):
+        self.assertTrue(self.footprint.intersects(bounding_box(-0.5, -0.5, 0.5, 0.5)))
+        # box within the bounding box of the polygon but outside of it
+        self.assertFalse(self.footprint.intersects(bounding_box(1.5, 1.5, 2, 2)))
+        # box crossing an edge without a corner inside the other shape
+        self.assertTrue(self.footprint.intersects(bounding_box(-3, -0.1, 3, 0.1)))
+        self.assertFalse(self.footprint.intersects(bounding_box(5, 5, 6, 6)))
+        self.assertTrue(self.footprint.intersects(None))
+
+    def test_covers(self):
+        self.assertTrue(self.footprint.covers(bounding_box(-0.5, -0.5, 0.5, 0.5)))
+        self.assertFalse(self.footprint.covers(bounding_box(-0.5, -0.5, 1.5, 1.5)))
+
+    def test_coverage(self):
+        self.assertEqual(self.footprint.coverage([bounding_box(-2, -2, 2, 2)]), 1.)
+        half = self.footprint.coverage([bounding_box(-2, -2, 0, 2)])
+        self.assertAlmostEqual(half, 0.5, delta=0.1)
+        self.assertEqual(self.footprint.coverage([]), 0.)
+
+
+if __name__ == '__main__':
+    test()